@@ -43,21 +43,32 @@ between Hadoop client machines and the Hadoop server environment."""
 ############################################################
 
 import ast
+import base64
 import copy
+import fcntl
 import getpass
 import glob
+import gzip
+import hashlib
+import hmac
+import io
 import json
 import logging
 import os
 import pdb
+import re
 import shlex
 import shutil
+import signal
 import socket
 import stat
 import sys
+import tarfile
 import tempfile
+import threading
 import time
 import traceback
+import zipfile
 from argparse import ArgumentParser
 # from optparse import OptionParser
 from pprint import pprint
@@ -66,8 +77,16 @@ import subprocess
 from subprocess import PIPE
 from subprocess import Popen
 from multiprocessing import Process, Queue
-from distutils.version import LooseVersion
+from multiprocessing.pool import ThreadPool
 import xml.etree.ElementTree as ET
+try:
+    from urllib.parse import quote as urlquote
+    from urllib.parse import parse_qsl, urlsplit
+    from http.client import HTTPConnection, HTTPSConnection, HTTPException
+except ImportError:
+    from urllib import quote as urlquote
+    from urlparse import parse_qsl, urlsplit
+    from httplib import HTTPConnection, HTTPSConnection, HTTPException
 
 ############################################################
 #   GLOBALS
@@ -84,10 +103,136 @@ USETIMEOUT = False
 # temporary cache for reruns
 DATACACHE = {}
 
+# strace -ff lines that start or fork a process
+STRACEEXECVE = re.compile(r'execve\("([^"]*)"')
+STRACECLONE = re.compile(r'(?:clone|clone3|fork|vfork)\(.*\)\s+=\s+(\d+)\s*$')
+
+# java install locations checked after the traced and running javas
+JAVAINSTALLROOTS = ['/usr/java/*', '/usr/jdk64/*', '/usr/lib/jvm/*',
+                    '/usr/lib64/jvm/*', '/opt/java/*', '/usr/local/java/*']
+
+# results of locatejdk(), keyed by its hints
+JDKCACHE = {}
+
+# process table snapshot, taken in main() before the tracers fork
+PROCTABLE = None
+
+# discovery results shared by the tracers, prefetched in main()
+PREFETCH = None
+
+# per service results saved for --resume, only files with this suffix
+# are read or removed from the checkpoint directory
+CHECKPOINTSUFFIX = '.checkpoint.json'
+
+# manifest kept in each output directory by SyncedDir
+MANIFESTNAME = '.hadooptracer-manifest.json'
+
+# copies the jars and site xmls of each service as soon as it finishes
+COPYPIPELINE = None
+COPYWORKERS = 8
+
+# object store uploads, see publish()
+PUBLISHCHUNK = 8 * 1024 * 1024
+PUBLISHWORKERS = 8
+PUBLISHRETRIES = 3
+
+# python 3 can time out a subprocess itself and kill its whole session,
+# python 2 has to wrap commands with timeout(1) or the bashtimeout script
+SESSIONTIMEOUTS = hasattr(subprocess, 'TimeoutExpired')
+
+# strace -s for the two capture tiers, see Tracer._strace
+STRACESTRSIZE = 1024
+STRACEFULLSTRSIZE = 100000
+
+# launcher helpers that never start java, their traces are skipped
+STRACELEAFCMDS = set(['awk', 'basename', 'cat', 'cut', 'date', 'dirname',
+                      'expr', 'find', 'getconf', 'grep', 'head', 'hostname',
+                      'id', 'ls', 'mkdir', 'readlink', 'rm', 'sed', 'sort',
+                      'tail', 'touch', 'tr', 'tput', 'uname', 'wc', 'which',
+                      'whoami'])
+
+# ways to capture the java command of a client launcher
+CAPTUREBACKENDS = ['strace', 'dry', 'proc']
+
+# launchers that print their classpath without starting java, see dry_capture
+CLASSPATHLAUNCHERS = {'hadoop': 'classpath', 'hdfs': 'classpath',
+                      'mapred': 'classpath', 'yarn': 'classpath',
+                      'hbase': 'classpath', 'hcat': '-classpath'}
+
+# java calls launchers make before the real one, dry_capture skips them
+JAVAPROBECLASSES = set(['org.apache.hadoop.util.VersionInfo',
+                        'org.apache.hadoop.util.Classpath',
+                        'org.apache.hadoop.util.PlatformName',
+                        'org.apache.hadoop.hbase.util.GetJavaProperty'])
+JAVAPROBEOPTIONS = set(['-version', '-fullversion', '-XshowSettings',
+                        '-XshowSettings:properties'])
+
+# generic options that keep a mapreduce job in the client jvm
+LOCALRUNNER = ['-D', 'mapreduce.framework.name=local',
+               '-D', 'mapred.job.tracker=local',
+               '-D', 'fs.defaultFS=file:///']
+
+# compiled java probes are kept here between runs
+PROBECACHE = os.path.join(os.path.expanduser('~'), '.cache', 'hadooptracer', 'probes')
+
 # global cache of jar contents
 JCCACHE = {}
 JCEXCLUSIONS = []
 
+# services whose JVMs load largely the same classes
+SERVICEFAMILIES = {'hadoop': 'hadoop',
+                   'hadoop-put': 'hadoop',
+                   'yarn-node': 'hadoop',
+                   'yarn-apps': 'hadoop',
+                   'mapreduce': 'hadoop',
+                   'maprlogin': 'hadoop',
+                   'checknative': 'hadoop',
+                   'hbase': 'hbase',
+                   'pig': 'pig',
+                   'pighcat': 'pig',
+                   'beeline': 'hive',
+                   'hivejdbc': 'hive',
+                   'hcatalog': 'hive',
+                   'hcatapi': 'hive',
+                   'hbasehcat': 'hive',
+                   'hivejson': 'hive',
+                   'oozie': 'oozie',
+                   'spark': 'spark'}
+
+# jars whose metadata carries the version of each service family, in the
+# order they are tried
+VERSIONJARS = {'hadoop': ['hadoop-common', 'hadoop-core'],
+               'hbase': ['hbase-common', 'hbase-client', 'hbase'],
+               'pig': ['pig'],
+               'hive': ['hive-exec', 'hive-common'],
+               'oozie': ['oozie-client', 'oozie-core'],
+               'spark': ['spark-core']}
+
+# versions read from jar metadata, keyed by jar path
+JARVERSIONS = {}
+
+# sha256 digests of files and dedupejars_by_checksum() results
+DIGESTS = {}
+DEDUPEDJARS = {}
+
+# split_jar_name_and_version() and version_key() results, keyed by input
+JARNAMES = {}
+VERSIONKEYS = {}
+
+# the first delimited part of a jar name starting with a digit begins
+# its version
+JARVERSIONSTART = {'-': re.compile(r'^(?:(.*?)-)?([0-9].*)$'),
+                   '_': re.compile(r'^(?:(.*?)_)?([0-9].*)$')}
+
+# qualifiers moved from the end of a jar version back onto its name
+JARNAMESUFFIXES = ['-tests', '-incubating', '-core', '-standalone']
+
+# leading dotted numbers of a version and the words and numbers after them
+VERSIONNUMBERS = re.compile(r'^([0-9]+(?:\.[0-9]+)*)(.*)$')
+VERSIONWORDS = re.compile(r'[a-z]+')
+VERSIONDIGITS = re.compile(r'[0-9]+')
+PRERELEASES = set(['alpha', 'beta', 'm', 'milestone', 'pre', 'rc', 'snapshot'])
+
 # create logging object
 LOG = logging.getLogger()
 LOG.setLevel(logging.INFO)
@@ -205,6 +350,11 @@ class Tracer(object):
 
     @staticmethod
     def get_cmd_paths():
+        """ Paths of the hadoop client commands, found once per run """
+        return prefetchcontext().get('cmdpaths', Tracer.find_cmd_paths)
+
+    @staticmethod
+    def find_cmd_paths():
         """ A common problem on hadoop clusters is that various client
             scripts are not added to any default paths. Users have to
             run a find command or ask a DBA where the commands live.
@@ -292,12 +442,30 @@ class Tracer(object):
                shorten=False, use_hcp=False, logerrors=True, timeout=TIMEOUT):
         """ Strace a java command, rerun it with -verbose:class and save data """
 
-        LOG.info("%s - calling strace", svckey)
         usetimeout = self.USETIMEOUT
-        rc, so, se = Tracer._strace(cmd, usetimeout=usetimeout, timeout=timeout,
-                                    options=self.options, workdir=self.workdir, svckey=svckey)
-        LOG.info("%s - strace rc: %s", svckey, rc)
-        rawdata = str(so) + str(se)
+        backend = self.capturebackend(svckey)
+        JRE = None
+        opened = []
+        if backend == 'dry':
+            LOG.info("%s - calling the launcher with a stub java", svckey)
+            rc, rawdata, javainfo, opened = dry_capture(cmd, timeout=timeout, workdir=self.workdir)
+            JRE, CLASSPATH, JAVACMD, JAVAENV = javainfo
+            LOG.info("%s - dry rc: %s", svckey, rc)
+            if not JRE:
+                LOG.info("%s - no java command was captured, using strace", svckey)
+                backend = 'strace'
+        elif backend == 'proc':
+            LOG.info("%s - watching /proc", svckey)
+            rc, rawdata, javainfo, opened = proc_capture(cmd, cwd=self.workdir, timeout=timeout)
+            JRE, CLASSPATH, JAVACMD, JAVAENV = javainfo
+            LOG.info("%s - proc rc: %s", svckey, rc)
+
+        if backend == 'strace':
+            LOG.info("%s - calling strace", svckey)
+            rc, so, se = Tracer._strace(cmd, usetimeout=usetimeout, timeout=timeout,
+                                        options=self.options, workdir=self.workdir, svckey=svckey)
+            LOG.info("%s - strace rc: %s", svckey, rc)
+            rawdata = str(so) + str(se)
 
         if self.options.noclean:
             fname = os.path.join(self.workdir, '%s.strace.out' % svckey)
@@ -305,8 +473,9 @@ class Tracer(object):
             f.write(rawdata)
             f.close()
 
-        LOG.debug("%s - parsing java info", svckey)
-        JRE, CLASSPATH, JAVACMD, JAVAENV = parse_strace_output(rawdata)
+        if backend == 'strace':
+            LOG.debug("%s - parsing java info", svckey)
+            JRE, CLASSPATH, JAVACMD, JAVAENV = parse_strace_output(rawdata)
         self.STRACED_CLASSPATH = CLASSPATH
 
         if not JRE or not CLASSPATH or not JAVACMD or not JAVAENV:
@@ -329,6 +498,10 @@ class Tracer(object):
         # Find and combine the HADOOP_CLASSPATH if allowed
         if use_hcp:
             HADOOP_CLASSPATH = get_hadoop_classpath(rawdata)
+            if not HADOOP_CLASSPATH:
+                HCPS = [x for x in JAVAENV if x.startswith('HADOOP_CLASSPATH=')]
+                if HCPS:
+                    HADOOP_CLASSPATH = HCPS[-1].replace('HADOOP_CLASSPATH=', '', 1)
             if HADOOP_CLASSPATH:
                 CLASSPATH = CLASSPATH + ':' + HADOOP_CLASSPATH
 
@@ -376,7 +549,14 @@ class Tracer(object):
                         CLASSPATH, self.options.excludepackage)
 
         LOG.info("%s - parsing sitexmls", svckey)
-        sitexmls = parse_strace_open_file(rawdata, "site.xml", list=True)
+        if backend == 'strace':
+            sitexmls = parse_strace_open_file(rawdata, "site.xml", list=True)
+            maprlogin = parse_strace_open_file(rawdata, "login.conf")
+            maprclusters = parse_strace_open_file(rawdata, "mapr-clusters.conf")
+        else:
+            sitexmls = [x for x in opened if x.endswith("site.xml")]
+            maprlogin = ([x for x in opened if x.endswith("login.conf")] or [None])[-1]
+            maprclusters = ([x for x in opened if x.endswith("mapr-clusters.conf")] or [None])[-1]
         if not sitexmls:
             sitexmls = []
 
@@ -390,13 +570,11 @@ class Tracer(object):
                 sitexmls = sitexmls + xmlfiles
 
         # get the mapr.login.conf if defined
-        maprlogin = parse_strace_open_file(rawdata, "login.conf")
         if maprlogin:
             LOG.info("%s - login.conf  %s", svckey, maprlogin)
             sitexmls.append(maprlogin)
 
         # get the mapr-clusters.conf if defined
-        maprclusters = parse_strace_open_file(rawdata, "mapr-clusters.conf")
         if maprclusters:
             LOG.info("%s - mapr-clusters.conf %s", svckey, maprclusters)
             sitexmls.append(maprclusters)
@@ -404,16 +582,24 @@ class Tracer(object):
         # Sort and unique the sitexmls
         sitexmls = sorted(set(sitexmls))
 
-        LOG.info("%s - re-running with -verbose:class", svckey)
-        vrc, rawdataj = javaverbose(self.options, CLASSPATH, JAVACMD,
-                                    JAVAENV, piping=piping, svckey=svckey,
-                                    usetimeout=usetimeout, timeout=timeout,
-                                    workdir=self.workdir)
-        LOG.debug("%s - verbose rc: %s", svckey, vrc)
-        LOG.debug("%s - parsing -verbose:class output", svckey)
-        ECLASSPATH = parseverboseoutput(rawdataj)
-        EJARS = classpathstojars(ECLASSPATH)
-        EJARS = Tracer.jrejarfilter(JRE, EJARS)
+        if backend == 'dry':
+            # no jvm was started, so take every jar on the classpath
+            LOG.info("%s - flattening the classpath", svckey)
+            vrc = 0
+            rawdataj = ''
+            ECLASSPATH = []
+            EJARS = [x for x in javaClasspathReducer(CLASSPATH).jars]
+        else:
+            LOG.info("%s - re-running with -verbose:class", svckey)
+            vrc, rawdataj = javaverbose(self.options, CLASSPATH, JAVACMD,
+                                        JAVAENV, piping=piping, svckey=svckey,
+                                        usetimeout=usetimeout, timeout=timeout,
+                                        workdir=self.workdir)
+            LOG.debug("%s - verbose rc: %s", svckey, vrc)
+            LOG.debug("%s - parsing -verbose:class output", svckey)
+            ECLASSPATH = parseverboseoutput(rawdataj)
+            EJARS = classpathstojars(ECLASSPATH)
+            EJARS = Tracer.jrejarfilter(JRE, EJARS)
 
         if self.options.noclean:
             fname = os.path.join(self.workdir, '%s.javaverbose.out' % svckey)
@@ -442,6 +628,10 @@ class Tracer(object):
         if svckey:
             LOG.info("%s - strace finished (stracerc: %s verboserc: %s) ", svckey, rc, vrc)
 
+    def capturebackend(self, svckey):
+        """ Pick the exec capture backend for a service """
+        return capture_backend(self.options, svckey)
+
     @staticmethod
     def _strace(
             cmd,
@@ -452,10 +642,19 @@ class Tracer(object):
             options=None,
             workdir=WORKDIR,
             poll=False,
-            svckey=None):
+            svckey=None,
+            strsize=None):
         """ Wrap input command with strace and return output """
 
-        # Forcefully kill the command if it runs too long
+        # Forcefully kill the command if it runs too long. The watcher
+        # does that itself for the whole session, live output still
+        # needs a wrapper.
+        pw = None
+        watch = follow_threads and not options.verbose and not options.poll
+        sessiontimeout = None
+        if usetimeout and watch and SESSIONTIMEOUTS:
+            usetimeout = False
+            sessiontimeout = timeout
         if usetimeout:
             timeoutcmd = None
             if checkcmdinpath('timeout') and 'beeline' not in cmd:
@@ -464,15 +663,35 @@ class Tracer(object):
             else:
                 timeoutcmd = bashtimeout(workdir=workdir, timeout=timeout)
 
+        # Strings are captured in two tiers. The open() paths only need a
+        # short -s, while the long java argv and environment are read
+        # from /proc as the jvm runs. Live output has no watcher, so it
+        # keeps full length strings.
+        if not strsize:
+            strsize = STRACESTRSIZE if watch else STRACEFULLSTRSIZE
+
+        # Each process is traced to its own file, so the launcher's
+        # helper processes can be dropped without parsing them.
+        tracedir = None
         if follow_threads:
-            args = "strace -s 100000 -fftv -e trace=execve,open %s 2>&1" % (cmd)
+            if not os.path.isdir(workdir):
+                os.makedirs(workdir)
+            tracedir = tempfile.mkdtemp(prefix='strace.', dir=workdir)
+            args = "strace -s %s -fftv -o %s/trace -e trace=process,open %s 2>&1" % (strsize, tracedir, cmd)
         else:
-            args = "strace -s 100000 -tv -e trace=execve,open %s 2>&1" % (cmd)
+            args = "strace -s %s -tv -e trace=execve,open %s 2>&1" % (strsize, cmd)
         if usetimeout:
             args = "%s %s" % (timeoutcmd, args)
 
         p = None
-        if not options.verbose and not options.poll:
+        if watch:
+            # only the java argv and environment are needed and a traced
+            # jvm takes seconds to start, so a slow poll is enough
+            pw = ProcWatcher(args, cwd=cwd, timeout=sessiontimeout,
+                             interval=0.25, openfiles=False)
+            (rc, so) = pw.run()
+            se = None
+        elif not options.verbose and not options.poll:
             # p = Popen(args, cwd=cwd, stdout=PIPE, stderr=PIPE, shell=True)
             p = Popen(
                 args,
@@ -489,31 +708,41 @@ class Tracer(object):
                                             verbose=options.verbose,
                                             svckey=svckey)
 
-        if str(sys.version).startswith('3'):
+        if str(sys.version).startswith('3') and not pw:
             if so is not None:
                 so = so.decode('utf-8')
             if se is not None:
                 se = se.decode('utf-8')
 
+        if tracedir:
+            (javapid, javatrace) = strace_java_trace(os.path.join(tracedir, 'trace'))
+            if not options.noclean:
+                shutil.rmtree(tracedir, ignore_errors=True)
+
+            # swap a truncated java execve for the full one from /proc
+            if javatrace and strsize < STRACEFULLSTRSIZE:
+                lines = javatrace.split('\n')
+                for idx, line in enumerate(lines):
+                    if 'execve(' in line and '"...' in line:
+                        if pw and javapid in pw.javas:
+                            lines[idx] = strace_execve_line(
+                                line.split()[0], pw.javas[javapid][1], pw.javas[javapid][2])
+                        else:
+                            LOG.warning("%s - the jvm exited before it was seen, "
+                                        "its strace'd command is truncated", svckey)
+                        break
+                javatrace = '\n'.join(lines)
+
+            so = str(so) + javatrace
+
         return rc, so, se
 
     @staticmethod
     def get_jdk_jre_jar_commands():
         """ Get JDK JRE jar command """
 
-        jdk = None
-        jre = None
-        jarcmd = None
-
         # setup necessary java tools
-        jdkbasedir = locatejdkbasedir()
-        if jdkbasedir:
-            if os.path.isfile(os.path.join(jdkbasedir, 'javac')):
-                jdk = os.path.join(jdkbasedir, 'javac')
-            if os.path.isfile(os.path.join(jdkbasedir, 'jar')):
-                jarcmd = os.path.join(jdkbasedir, 'jar')
-            if os.path.isfile(os.path.join(jdkbasedir, 'java')):
-                jre = os.path.join(jdkbasedir, 'java')
+        (jre, jdk, jarcmd) = prefetchcontext().get('jdk', locatejdk)
 
         if not jdk:
             if checkcmdinpath('javac'):
@@ -530,6 +759,12 @@ class Tracer(object):
     @staticmethod
     def run_and_parse_classpath(cmd=None):
         """ Find all jars listed by a cli's classpath subcommand """
+        return prefetchcontext().get(
+            cmd, Tracer.parse_classpath_command, cmd)
+
+    @staticmethod
+    def parse_classpath_command(cmd):
+        """ Run a cli's classpath subcommand and split its dirs and jars """
 
         dirs = []  # these are dirpaths without globs at the end
         jars = []  # explicit list of flattened jars
@@ -566,40 +801,30 @@ class Tracer(object):
     def dedupejars_by_checksum(jarlist):
         ''' delete duplicate jars by md5sum '''
 
-        md5cmd = getcmdpath('md5sum')
-        jardict = {}
+        key = tuple(jarlist)
+        if key in DEDUPEDJARS:
+            return list(DEDUPEDJARS[key])
 
         # Include the real paths for each jar
-        for idx, x in enumerate(jarlist):
+        jars = list(jarlist)
+        for x in jarlist:
             xrp = os.path.realpath(x)
             if xrp != x:
-                jarlist.append(xrp)
+                jars.append(xrp)
 
-        for x in jarlist:
-            cmd = "%s %s | awk '{print $1}'" % (md5cmd, x)
-            (rc, so, se) = run_command(cmd, checkrc=False)
-            md5 = so.strip()
-            if md5 not in jardict:
-                jardict[md5] = []
-            jardict[md5].append(x)
+        jardict = {}
+        for x in jars:
+            digest = file_digest(x) or x
+            if digest not in jardict:
+                jardict[digest] = []
+            jardict[digest].append(x)
 
         for k, v in jardict.items():
             if len(v) == 1:
                 continue
 
-            # find the longest basename and filepath
-            longest_bn = None
-
-            for idj, jf in enumerate(v):
-                jf_basename = os.path.basename(jf)
-
-                if not longest_bn:
-                    longest_bn = jf_basename
-                else:
-                    if len(jf_basename) > len(longest_bn):
-                        longest_bn = jf_basename
-
-            # Narrow down by basename ...
+            # Narrow down by the longest basename ...
+            longest_bn = max([os.path.basename(x) for x in v], key=len)
             jardict[k] = [x for x in v if os.path.basename(x) == longest_bn]
             if len(jardict[k]) > 1:
                 # Narrow down by longest filepath ...
@@ -608,7 +833,9 @@ class Tracer(object):
         out_cp = []
         for k, v in jardict.items():
             out_cp.append(v[0])
-        return out_cp
+
+        DEDUPEDJARS[key] = out_cp
+        return list(out_cp)
 
     @staticmethod
     def split_jar_name_and_version(jarname):
@@ -618,56 +845,69 @@ class Tracer(object):
         # parquet-scala_2.10.jar
         # ('servlet-api', 'servlet-api')
 
-        name = None
-        version = ''
-
-        # python3 xrange() was renamed to range()
-        if str(sys.version).startswith('3'):
-            ints = range(0, 9)
-        else:
-            ints = xrange(0, 9)
-
-        ints = [str(x) for x in ints]
+        if jarname in JARNAMES:
+            return JARNAMES[jarname]
 
         delimiter = '-'
         if '_' in jarname:
             delimiter = '_'
 
-        jarname = jarname.replace('.jar', '')
-        parts = jarname.split(delimiter)
+        bn = jarname.replace('.jar', '')
 
-        if len(parts) == 1:
-            name = parts[0]
+        if delimiter not in bn:
+            name = bn
             version = ''
         else:
-            names = []
-            version_idx = None
-            for idx, x in enumerate(parts):
-                if x[0] not in ints:
-                    names.append(x)
-                else:
-                    version_idx = idx
-                    break
-
-            name = delimiter.join(names)
-            version = delimiter.join(parts[version_idx:])
-            if version.endswith('-tests'):
-                version = version.replace('-tests', '')
-                name += "-tests"
+            m = JARVERSIONSTART[delimiter].match(bn)
+            if m:
+                name = m.group(1) or ''
+                version = m.group(2)
+            else:
+                # nothing looks like a version, so the whole name is one
+                name = bn
+                version = bn
 
-            if version.endswith('-incubating'):
-                version = version.replace('-incubating', '')
-                name += "-incubating"
+            for suffix in JARNAMESUFFIXES:
+                if version.endswith(suffix):
+                    version = version[:-len(suffix)]
+                    name += suffix
 
-            if version.endswith('-core'):
-                version = version.replace('-core', '')
-                name += "-core"
+        JARNAMES[jarname] = (name, delimiter, version)
+        return JARNAMES[jarname]
 
-            if version.endswith('-standalone'):
-                version = version.replace('-standalone', '')
-                name += "-standalone"
+    @staticmethod
+    def version_key(version):
+        """ Sort key for jar versions that knows the vendor conventions """
+
+        # 2.6.0-cdh5.16.2     cdh: upstream, vendor release
+        # 2.7.3.2.6.5.0-292   hdp/cdp: upstream, stack version, build
+        # 2.7.0-mapr-1808     mapr: upstream, vendor release
+        # 2.8.5-amzn-4        emr: upstream, vendor release
+        # 6.1.26.cloudera.4   patched upstream
+        # 3.0.0-SNAPSHOT      sorts before 3.0.0
+
+        if version in VERSIONKEYS:
+            return VERSIONKEYS[version]
+
+        # The whole dotted number is compared first, so a stack version
+        # appended to the upstream one sorts above the plain upstream and
+        # 1.2.3.4.5 above 1.2.3.4. The qualifier only breaks ties.
+        m = VERSIONNUMBERS.match(version.lower())
+        if not m:
+            key = ((), 0, (), (version,))
+        else:
+            nums = tuple(int(x) for x in m.group(1).split('.'))
+            words = tuple(VERSIONWORDS.findall(m.group(2)))
+            restnums = tuple(int(x) for x in VERSIONDIGITS.findall(m.group(2)))
+            if PRERELEASES.intersection(words):
+                key = (nums, -1, restnums, words)
+            elif words:
+                key = (nums, 1, restnums, words)
+            else:
+                key = (nums, 0, restnums, words)
 
-        return (name, delimiter, version)
+        VERSIONKEYS[version] = key
+        return key
 
     @staticmethod
     def filter_jars_by_hadoop_classpath(inclasspath, hcp_jars=None, verbose=False):
@@ -680,22 +920,21 @@ class Tracer(object):
             hcp_jars = hadoopclasspathcmd()
         hcp_jars = Tracer.dedupejars_by_checksum(hcp_jars)
 
-        # Iterate each jar and get the name|version
-        hcp_versions = []
-        for idx, x in enumerate(hcp_jars):
-            xbn = os.path.basename(x)
-            (xname, xdelimiter, xversion) = Tracer.split_jar_name_and_version(xbn)
-            if xversion:
-                hcp_versions.append((xname, xdelimiter, xversion, x))
-            else:
+        # Index each jar's name|version by name
+        hcp_versions = {}
+        hcp_basenames = set()
+        for x in hcp_jars:
+            (xname, xdelimiter, xversion) = \
+                Tracer.split_jar_name_and_version(os.path.basename(x))
+            if not xversion:
                 # Check the real path for a versioned jar filename
-                xrp = os.path.realpath(x)
-                (xname, xdelimiter, xversion) = Tracer.split_jar_name_and_version(xrp)
-                hcp_versions.append((xname, xdelimiter, xversion, xrp))
-                hcp_jars[idx] = xrp
-
-        # Get a list of basenames for comparison ...
-        hcp_basenames = sorted(set(os.path.basename(x) for x in hcp_jars))
+                x = os.path.realpath(x)
+                (xname, xdelimiter, xversion) = \
+                    Tracer.split_jar_name_and_version(os.path.basename(x))
+            if xname not in hcp_versions:
+                hcp_versions[xname] = []
+            hcp_versions[xname].append((xname, xdelimiter, xversion, x))
+            hcp_basenames.add(os.path.basename(x))
 
         # Make a list from the input jars
         if type(inclasspath) != list:
@@ -709,40 +948,41 @@ class Tracer(object):
                 in_jars += xjars
             elif x.endswith('.jar'):
                 in_jars.append(x)
-        in_basenames = sorted(set(os.path.basename(x) for x in in_jars))
+        in_basenames = set(os.path.basename(x) for x in in_jars)
 
         # Mark any jars that should be removed
-        to_delete = []
+        to_delete = set()
         for x in in_basenames:
             if x in hcp_basenames:
                 continue
-            else:
-                (xname, xdelimiter, xversion) = Tracer.split_jar_name_and_version(x)
-                for hcpv in hcp_versions:
-                    if hcpv[0] == xname:
-                        if xversion != hcpv[2]:
-                            to_delete.append((xname, xdelimiter, xversion))
-
-        to_delete = sorted(set(to_delete))
+            (xname, xdelimiter, xversion) = Tracer.split_jar_name_and_version(x)
+            for hcpv in hcp_versions.get(xname, []):
+                if xversion != hcpv[2]:
+                    to_delete.add((xname, xdelimiter, xversion))
+                    break
 
         # Create a list without the marked jars
-        out_jars = in_jars
-        for td in to_delete:
+        delete_bns = {}
+        for td in sorted(to_delete):
             if td[1] != '':
                 bn = td[1].join([td[0], td[2]]) + '.jar'
             else:
                 bn = ''.join([td[0], td[2]]) + '.jar'
-            out_jars = [x for x in out_jars if os.path.basename(x) != bn]
-
-            # add the hcp jar if none remains ...
-            for hcp_v in hcp_versions:
-                if hcp_v[0] == td[0]:
-                    if hcp_v[3] not in out_jars:
-                        if verbose:
-                            LOG.debug(
-                                "Replacing %s with %s because of hadoop cp filter",
-                                bn + '.jar', hcp_v[3])
-                        out_jars.append(hcp_v[3])
+            delete_bns[bn] = td
+        out_jars = [x for x in in_jars
+                    if os.path.basename(x) not in delete_bns]
+
+        # add the hcp jar if none remains ...
+        out_set = set(out_jars)
+        for bn, td in sorted(delete_bns.items(), key=lambda x: x[1]):
+            for hcp_v in hcp_versions.get(td[0], []):
+                if hcp_v[3] not in out_set:
+                    if verbose:
+                        LOG.debug(
+                            "Replacing %s with %s because of hadoop cp filter",
+                            bn + '.jar', hcp_v[3])
+                    out_jars.append(hcp_v[3])
+                    out_set.add(hcp_v[3])
 
         return out_jars
 
@@ -967,7 +1207,7 @@ class Tracer(object):
 
         # deduped_jars = Tracer.dedupejars_by_checksum(injars)
         injars = sorted(set([os.path.realpath(x) for x in injars]))
-        exclude = []
+        exclude = set()
         jardict = {}
         for x in injars:
             (xname, xdelimiter, xversion) = Tracer.split_jar_name_and_version(
@@ -983,28 +1223,23 @@ class Tracer(object):
             if len(list(v.keys())) < 2:
                 continue
 
-            latest = sorted(list(v.keys()), key=lambda x: LooseVersion(x))
-            latest = latest[-1]
+            latest = max(v.keys(), key=Tracer.version_key)
 
             for k2, v2 in v.items():
                 if k2 != latest:
-                    for x in v2:
-                        if x not in exclude:
-                            exclude.append(x)
+                    exclude.update(v2)
 
-        for x in exclude:
-            if x in injars:
-                LOG.debug("[filter:latest] removing %s", x)
-                injars.remove(x)
+        for x in sorted(exclude):
+            LOG.debug("[filter:latest] removing %s", x)
 
-        return injars
+        return [x for x in injars if x not in exclude]
 
     @staticmethod
     def filter_jars_by_count(injars):
         """ Filtering collected JAR files by counts """
 
         injars = sorted(set([os.path.realpath(x) for x in injars]))
-        exclude = []
+        exclude = set()
         jardict = {}
         for x in injars:
             (xname, xdelimiter, xversion) = Tracer.split_jar_name_and_version(
@@ -1020,9 +1255,6 @@ class Tracer(object):
             if len(list(v.keys())) < 2:
                 continue
 
-            latest = sorted(list(v.keys()), key=lambda x: LooseVersion(x))
-            latest = latest[-1]
-
             highest_count = None
             for k2, v2 in v.items():
                 if not highest_count:
@@ -1033,16 +1265,12 @@ class Tracer(object):
 
             for k2, v2 in v.items():
                 if k2 != highest_count:
-                    for x in v2:
-                        if x not in exclude:
-                            exclude.append(x)
+                    exclude.update(v2)
 
-        for x in exclude:
-            if x in injars:
-                LOG.debug("[filter:count] removing %s", x)
-                injars.remove(x)
+        for x in sorted(exclude):
+            LOG.debug("[filter:count] removing %s", x)
 
-        return injars
+        return [x for x in injars if x not in exclude]
 
     @staticmethod
     def jrejarfilter(jre, jars):
@@ -1349,22 +1577,31 @@ class HiveJdbcTrace(Tracer):
         else:
             self.jdbc_classpath = self.classpath
 
-        # Chop up the classpath into multiple lines to avoid max command lengths
+        # Pass the classpath through a launcher jar to avoid max command lengths
         LOG.debug("hivejdbc - creating verbose build script")
-        BASHCP = ""
         if not self.jdbc_classpath:
             # Exit now to avoid tracebacks later
             LOG.error('hivejdbc - no jdbc classpath was found')
             return False
         CPS = [x for x in self.jdbc_classpath.split(':') if x]
-        for idx, x in enumerate(CPS):
-            if idx == 0:
-                BASHCP = 'export CLASSPATH=".:%s"\n' % x
-            else:
-                BASHCP += 'export CLASSPATH="$CLASSPATH:%s"\n' % x
 
-        # Substitute, replace and create the final buildscript
+        # Build the client once, the makefile then only has to run it
         HIVEJDBCPGM = HIVEJDBCCODE % (self.jdbcparams)
+        probejar = os.path.join(self.workdir, 'hivejdbc-probe.jar')
+        (rc, so, se) = compile_probe(
+            'hivejdbc', {'HiveJdbcClient.java': HIVEJDBCPGM}, CPS, self.jdk, probejar)
+        if rc != 0:
+            for x in [x for x in (str(so) + str(se)).split('\n') if x.strip()]:
+                LOG.error("hivejdbc - %s", x)
+            return False
+
+        BASHCP = classpath_export(
+            os.path.join(self.workdir, 'hivejdbc-classpath.jar'),
+            [self.workdir, probejar] + CPS)
+
+        # Substitute, replace and create the final buildscript
+        # CODE and JDK are only used by driver files that predate the
+        # precompiled client
         ddict = {
             'CODE': HIVEJDBCPGM,
             'CLASSPATH': BASHCP,
@@ -1422,11 +1659,123 @@ class HiveJdbcTrace(Tracer):
                 self.jars = [
                     x for x in Tracer.jrejarfilter(
                         self.jre, self.jars)]
+                self.jars = [x for x in self.jars if not x.startswith(self.workdir)]
 
         self.jarfiles = self.jars
         LOG.debug('hivejdbc - total jars: %s', len(self.jars))
 
 
+############################################################
+#   HDFS STAGING
+############################################################
+
+HDFSSTAGECODE = """
+import java.io.BufferedReader;
+import java.io.FileReader;
+
+import org.apache.hadoop.conf.Configuration;
+import org.apache.hadoop.fs.FsShell;
+import org.apache.hadoop.util.ToolRunner;
+
+public class HdfsStage {
+  public static void main(String[] args) throws Exception {
+    FsShell shell = new FsShell(new Configuration());
+    BufferedReader in = new BufferedReader(new FileReader(args[0]));
+    String line;
+    int rc = 0;
+    while ((line = in.readLine()) != null) {
+      if (line.trim().length() == 0) {
+        continue;
+      }
+      int r = ToolRunner.run(shell, line.split("\\t"));
+      System.out.println("HDFSSTAGE " + r);
+      if (r != 0) {
+        rc = r;
+      }
+    }
+    in.close();
+    shell.close();
+    System.exit(rc);
+  }
+}
+"""
+
+
+class HdfsStager(object):
+    """ Queue hdfs staging commands and run them in one client jvm """
+
+    def __init__(self, svckey, workdir, jdk=None):
+        self.svckey = svckey
+        self.workdir = workdir
+        self.jdk = jdk
+        self.ops = []
+
+    def mkdir(self, *paths):
+        self.ops.append(['-mkdir', '-p'] + list(paths))
+
+    def put(self, srcs, dest):
+        self.ops.append(['-put'] + list(srcs) + [dest])
+
+    def rm(self, *paths):
+        self.ops.append(['-rm', '-r', '-f', '-skipTrash'] + list(paths))
+
+    def test(self, path):
+        self.ops.append(['-test', '-e', path])
+
+    def helperjar(self):
+        """ Build the FsShell batch helper, None if there is no jdk """
+
+        jdk = self.jdk
+        if not jdk and checkcmdinpath('javac'):
+            jdk = getcmdpath('javac')
+        if not jdk:
+            return None
+
+        jarf = os.path.join(self.workdir, 'hdfsstage.jar')
+        if os.path.isfile(jarf):
+            return jarf
+        (rc, so, se) = compile_probe(
+            'hdfsstage', {'HdfsStage.java': HDFSSTAGECODE},
+            hadoopclasspathcmd(), jdk, jarf)
+        if rc != 0:
+            LOG.debug("%s - hdfs stage helper failed to build", self.svckey)
+            return None
+        return jarf
+
+    def run(self):
+        """ Run the queued commands, return their exit codes in order """
+
+        ops = self.ops
+        self.ops = []
+        if not ops:
+            return []
+
+        jarf = self.helperjar()
+        if jarf:
+            batchfile = tempfile.mkstemp(prefix='hdfsstage.', dir=self.workdir)[1]
+            f = open(batchfile, 'w')
+            for op in ops:
+                f.write('\t'.join(op) + '\n')
+            f.close()
+
+            LOG.debug("%s - staging %s hdfs commands in one jvm", self.svckey, len(ops))
+            cmd = 'hadoop jar %s HdfsStage %s' % (jarf, batchfile)
+            (rc, so, se) = run_command(cmd, cwd=self.workdir, checkrc=False)
+            rcs = [int(x.split()[1]) for x in str(so).split('\n')
+                   if x.startswith('HDFSSTAGE ')]
+            if len(rcs) == len(ops):
+                return rcs
+            LOG.debug("%s - hdfs stage helper failed [%s]", self.svckey, rc)
+
+        # one hadoop fs call per command
+        rcs = []
+        for op in ops:
+            cmd = 'hadoop fs %s' % ' '.join(op)
+            (rc, so, se) = run_command(cmd, cwd=self.workdir, checkrc=False)
+            rcs.append(rc)
+        return rcs
+
+
 ############################################################
 #   MAPREDUCE HELPER CODE
 ############################################################
@@ -1519,34 +1868,11 @@ class MapReduceTrace(Tracer):
     def compilejava(self):
         """  compile the wordcount code """
 
-        # write out the java file
-        jfile = os.path.join(self.workdir, "WordCount.java")
-        f = open(jfile, "w")
-        f.write(self.wc_code)
-        f.close()
-
-        # compile the code
-        classdir = os.path.join(self.workdir, "wordcount_classes")
-        os.makedirs(classdir)
-        makefile = os.path.join(self.workdir, 'build.sh')
-        f = open(makefile, "w")
-        f.write("#!/bin/bash\n")
-        f.write("CLASSPATH=$(hadoop classpath)\n")
-        f.write("%s -cp $CLASSPATH -d wordcount_classes WordCount.java\n" % self.jdk)
-        f.write("RC=$?\n")
-        f.write("if [ $RC != 0 ]; then\n")
-        f.write("   exit $RC\n")
-        f.write("fi\n")
-        f.write("%s -cvf wordcount.jar -C wordcount_classes/ .\n" % self.jarcmd)
-        f.write("RC=$?\n")
-        f.write("if [ $RC != 0 ]; then\n")
-        f.write("   exit $RC\n")
-        f.write("fi\n")
-        f.close()
-
         LOG.debug("mapreduce - compile wordcount.jar")
-        cmd = "bash -x build.sh"
-        (rc, so, se) = run_command(cmd, cwd=self.workdir, checkrc=False)
+        (rc, so, se) = compile_probe(
+            'wordcount', {'WordCount.java': self.wc_code},
+            hadoopclasspathcmd(), self.jdk,
+            os.path.join(self.workdir, 'wordcount.jar'))
         if rc != 0:
             data = [x for x in (str(so) + str(se)).split("\n") if x]
             for x in data:
@@ -1580,42 +1906,55 @@ class MapReduceTrace(Tracer):
         f.write('Hello Hadoop Goodbye Hadoop\n')
         f.close()
 
-        cmd = 'hadoop fs -mkdir %s\n' % tdir1
-        (rc, so, se) = run_command(cmd, cwd=self.workdir, checkrc=False)
-        tlog.write('%s\n' % rc)
-        cmd = 'hadoop fs -mkdir %s\n' % tdir2
-        (rc, so, se) = run_command(cmd, cwd=self.workdir, checkrc=False)
-        tlog.write('%s\n' % rc)
-
-        cmd = 'hadoop fs -mkdir %s/input\n' % tdir1
-        (rc, so, se) = run_command(cmd, cwd=self.workdir, checkrc=False)
-        tlog.write('%s\n' % rc)
-        cmd = 'hadoop fs -mkdir %s/input\n' % tdir2
-        (rc, so, se) = run_command(cmd, cwd=self.workdir, checkrc=False)
-        tlog.write('%s\n' % rc)
+        if self.options.localprobes:
+            tlog.close()
+            self.runlocalmapreduce()
+            return
 
         # Put fake data into hdfs
-        cmd = 'hadoop fs -put %s/file* %s/input\n' % (self.workdir, tdir1)
-        (rc, so, se) = run_command(cmd, cwd=self.workdir, checkrc=False)
-        tlog.write('%s\n' % rc)
-        cmd = 'hadoop fs -put %s/file* %s/input\n' % (self.workdir, tdir2)
-        (rc, so, se) = run_command(cmd, cwd=self.workdir, checkrc=False)
-        tlog.write('%s\n' % rc)
+        stager = HdfsStager('mapreduce', self.workdir, jdk=self.jdk)
+        srcs = ['%s/file0' % self.workdir, '%s/file1' % self.workdir]
+        stager.mkdir('%s/input' % tdir1, '%s/input' % tdir2)
+        stager.put(srcs, '%s/input' % tdir1)
+        stager.put(srcs, '%s/input' % tdir2)
+        stager.test('%s/input' % tdir2)
+        rcs = stager.run()
+        for rc in rcs:
+            tlog.write('%s\n' % rc)
         tlog.close()
+        if rcs[-1] != 0:
+            LOG.error("mapreduce - %s/input was not created", tdir2)
 
-        # wait for src2 to get created [prone to race conditions]
-        rc = 1
-        retries = 5
-        while rc != 0 and retries > 0:
-            LOG.debug("mapreduce - waiting for %s/input creation", tdir2)
-            time.sleep(2)
-            cmd = 'hadoop fs -ls %s/input\n' % tdir2
-            (rc, so, se) = run_command(cmd, cwd=self.workdir, checkrc=False)
-            retries -= 1
+        self.tracewordcount(tdir1, tdir2)
+
+        # Cleanup
+        stager.rm(tdir1, tdir2)
+        stager.run()
+
+    def runlocalmapreduce(self):
+        """  Run the MapReduce job with the local runner """
+
+        # The client classes are the same as for a yarn submission, but
+        # the job runs in-process against the local filesystem.
+        tdirs = []
+        for x in ['wordcount1', 'wordcount2']:
+            tdir = os.path.join(self.workdir, x)
+            os.makedirs(os.path.join(tdir, 'input'))
+            for fn in ['file0', 'file1']:
+                shutil.copy(os.path.join(self.workdir, fn), os.path.join(tdir, 'input'))
+            tdirs.append('file://' + tdir)
+
+        LOG.debug("mapreduce - using the local job runner")
+        self.tracewordcount(tdirs[0], tdirs[1], genericopts=LOCALRUNNER)
+
+    def tracewordcount(self, tdir1, tdir2, genericopts=None):
+        """  Trace the wordcount job, then rerun it with -verbose:class """
 
         # run it once to get the full java command
         LOG.debug("mapreduce - hadoop jar wordcount.jar")
         cmd = 'hadoop jar %s/wordcount.jar org.apache.hadoop.examples.WordCount' % self.workdir
+        if genericopts:
+            cmd += ' ' + ' '.join(genericopts)
         cmd += ' %s/input %s/output' % (tdir1, tdir1)
         (rc2, so2, se2) = Tracer._strace(cmd, options=self.options, svckey=self.svckey)
         self.rc_strace = rc2
@@ -1653,12 +1992,6 @@ class MapReduceTrace(Tracer):
             jars = classpathstojars(self.classpaths)
             self.jars = Tracer.jrejarfilter(JRE, jars)
 
-        # Cleanup
-        cmd = "hadoop fs -rm -f -R -skipTrash %s" % tdir1
-        run_command(cmd, cwd=self.workdir, checkrc=False)
-        cmd = "hadoop fs -rm -f -R -skipTrash %s" % tdir2
-        run_command(cmd, cwd=self.workdir, checkrc=False)
-
 
 peoplejson = """{"name":"Michael"}
 {"name":"Andy", "age":30}
@@ -1692,13 +2025,7 @@ class SparkTrace(Tracer):
         spark_jars = []
         spark_dirs = []
         spark_sitexmls = []
-        self.sparksubmit = 'spark-submit'
-        if os.path.isdir("/opt/cloudera"):
-            (rc, so, se) = run_command("ls /opt/cloudera/parcels/")
-            if rc == 0 and ("CDH-6" in so or "CDH-7" in so):
-                self.sparksubmit = "spark-submit"
-            else:
-                self.sparksubmit = "spark2-submit"
+        self.sparksubmit = SparkTrace.findsparksubmit()
         if checkcmdinpath(self.sparksubmit) is False:
             LOG.error("spark submit cli command %s not found in the user's PATH", self.sparksubmit)
             return False
@@ -1758,56 +2085,46 @@ class SparkTrace(Tracer):
         # Add any sitexmls from spark that weren't found
         LOG.info("spark - finished")
 
+    @staticmethod
+    def findsparksubmit():
+        """ Name of the spark-submit cli for this distribution """
+
+        sparksubmit = 'spark-submit'
+        if os.path.isdir("/opt/cloudera"):
+            (rc, so, se) = run_command("ls /opt/cloudera/parcels/")
+            if rc == 0 and ("CDH-6" in so or "CDH-7" in so):
+                sparksubmit = "spark-submit"
+            else:
+                sparksubmit = "spark2-submit"
+        return sparksubmit
+
     def compilejava(self):
         ''' compile the wordcount code '''
-        # compile the wordcount code
-
-        # write out the java file
-        jfile = os.path.join(self.workdir, "JavaSparkSQLExample.java")
-        f = open(jfile, "w")
-        f.write(self.wc_code)
-        f.close()
 
-        # compile the code
-        classdir = os.path.join(self.workdir, "wordcount_classes")
-        os.makedirs(classdir)
-        makefile = os.path.join(self.workdir, 'build.sh')
-        f = open(makefile, "w")
-        f.write("#!/bin/bash\n")
+        # compile against the hadoop and spark jars
+        classpath = hadoopclasspathcmd()
+        sparkdir = None
         if os.path.isdir("/usr/hdp/current/spark2-client/jars/"):
-            f.write("CLASSPATH=$(hadoop classpath):/usr/hdp/current/spark2-client/jars/*\n")
+            sparkdir = "/usr/hdp/current/spark2-client/jars"
         elif os.path.isdir("/usr/lib/spark/jars/"):
-            f.write("CLASSPATH=$(hadoop classpath):/usr/lib/spark/jars/*\n")
+            sparkdir = "/usr/lib/spark/jars"
         elif os.path.isdir("/opt/cloudera/parcels/SPARK2/lib/spark2/jars"):
-            f.write("CLASSPATH=$(hadoop classpath):/opt/cloudera/parcels/SPARK2/lib/spark2/jars/*\n")
+            sparkdir = "/opt/cloudera/parcels/SPARK2/lib/spark2/jars"
         elif os.path.isdir("/opt/cloudera/parcels/CDH/lib/spark/jars/"):
-            sparkdir = "/opt/cloudera/parcels/CDH/lib/spark/jars/*"
-            f.write("CLASSPATH=$(hadoop classpath):%s\n" % sparkdir)
+            sparkdir = "/opt/cloudera/parcels/CDH/lib/spark/jars"
         elif os.path.isdir("/opt/cloudera"):
             (rc, so, se) = run_command("find /opt/cloudera/parcels/ -name spark2 -print -quit 2>/dev/null")
             if rc == 0:
                 so = so.strip("\n")
-                sparkdir = so
-                if os.path.isdir(sparkdir + "/jars/"):
-                    sparkdir = sparkdir + "/jars/*"
-                    f.write("CLASSPATH=$(hadoop classpath):%s\n" % sparkdir)
-        else:
-            f.write("CLASSPATH=$(hadoop classpath)\n")
-        f.write("%s -cp $CLASSPATH -d wordcount_classes JavaSparkSQLExample.java\n" % self.jdk)
-        f.write("RC=$?\n")
-        f.write("if [ $RC != 0 ]; then\n")
-        f.write("   exit $RC\n")
-        f.write("fi\n")
-        f.write("%s -cvf wordcount.jar -C wordcount_classes/ .\n" % self.jarcmd)
-        f.write("RC=$?\n")
-        f.write("if [ $RC != 0 ]; then\n")
-        f.write("   exit $RC\n")
-        f.write("fi\n")
-        f.close()
+                if os.path.isdir(so + "/jars/"):
+                    sparkdir = so + "/jars"
+        if sparkdir:
+            classpath.append(sparkdir + "/*")
 
         LOG.debug("spark - compile wordcount.jar")
-        cmd = "bash -x build.sh"
-        (rc, so, se) = run_command(cmd, cwd=self.workdir, checkrc=False)
+        (rc, so, se) = compile_probe(
+            'sparkwordcount', {'JavaSparkSQLExample.java': self.wc_code},
+            classpath, self.jdk, os.path.join(self.workdir, 'wordcount.jar'))
         if rc != 0:
             data = [x for x in (str(so) + str(se)).split("\n") if x]
             for x in data:
@@ -1842,16 +2159,20 @@ class SparkTrace(Tracer):
         f.write(self.kdata)
         f.close()
 
-        cmd = 'hadoop fs -mkdir %s\n' % tdir1
-        (rc, so, se) = run_command(cmd, cwd=self.workdir, checkrc=False)
-        tlog.write('%s\n' % rc)
-        cmd = 'hadoop fs -mkdir %s/input\n' % tdir1
-        (rc, so, se) = run_command(cmd, cwd=self.workdir, checkrc=False)
-        tlog.write('%s\n' % rc)
-
-        cmd = 'hadoop fs -put %s/file* %s/input\n' % (self.workdir, tdir1)
-        (rc, so, se) = run_command(cmd, cwd=self.workdir, checkrc=False)
-        tlog.write('%s\n' % rc)
+        if self.options.localprobes:
+            # read the inputs from the local filesystem, not hdfs
+            tdir1 = os.path.join(self.workdir, 'spark')
+            os.makedirs(os.path.join(tdir1, 'input'))
+            for fn in ['file0', 'file1']:
+                shutil.copy(os.path.join(self.workdir, fn), os.path.join(tdir1, 'input'))
+            tdir1 = 'file://' + tdir1
+        else:
+            stager = HdfsStager('spark', self.workdir, jdk=self.jdk)
+            stager.mkdir('%s/input' % tdir1)
+            stager.put(glob.glob('%s/file*' % self.workdir), '%s/input' % tdir1)
+            for rc in stager.run():
+                tlog.write('%s\n' % rc)
+        tlog.close()
 
         # run it once to get the full java command
         LOG.debug("Spark - hadoop jar wordcount.jar")
@@ -1861,7 +2182,10 @@ class SparkTrace(Tracer):
         cmd = "export SPARK_MAJOR_VERSION=2"
         (rc, so, se) = run_command(cmd, cwd=self.workdir, checkrc=False)
         # cmd = 'spark-submit --class org.apache.spark.examples.sql.JavaSparkSQLExample --master local --num-executors 1 --driver-memory 512m --executor-memory 512m --executor-cores 1 %s/wordcount.jar' % self.workdir
-        cmd = '%s --class org.apache.spark.examples.sql.JavaSparkSQLExample --master local --num-executors 1 --driver-memory 512m --executor-memory 512m --executor-cores 1 %s/wordcount.jar' % (self.sparksubmit, self.workdir)
+        if self.options.localprobes:
+            cmd = '%s --class org.apache.spark.examples.sql.JavaSparkSQLExample --master local[1] --conf spark.hadoop.fs.defaultFS=file:/// --driver-memory 512m %s/wordcount.jar' % (self.sparksubmit, self.workdir)
+        else:
+            cmd = '%s --class org.apache.spark.examples.sql.JavaSparkSQLExample --master local --num-executors 1 --driver-memory 512m --executor-memory 512m --executor-cores 1 %s/wordcount.jar' % (self.sparksubmit, self.workdir)
         cmd += ' %s/input/file0 %s/input/file1 %s/file2' % (tdir1, tdir1, self.workdir)
         print(cmd)
         (rc2, so2, se2) = Tracer._strace(cmd, options=self.options, svckey=self.svckey)
@@ -1889,8 +2213,134 @@ class SparkTrace(Tracer):
             jars = classpathstojars(self.classpaths)
             self.jars = Tracer.jrejarfilter(JRE, jars)
 
-        cmd = "hadoop fs -rm -f -R -skipTrash %s" % tdir1
-        run_command(cmd, cwd=self.workdir, checkrc=False)
+        if not self.options.localprobes:
+            stager.rm(tdir1)
+            stager.run()
+
+
+class SparkLauncherTrace(SparkTrace):
+    """ Get the spark client command from the spark launcher library """
+
+    # org.apache.spark.launcher.Main is what spark-class runs to build
+    # the final java command. It prints that command without starting a
+    # SparkContext, so the classpath is known in well under a second.
+    # The command is built for spark-submit --version, which is then run
+    # once with -verbose:class for the loaded classes. It is used for
+    # the spark service with the dry backend or "class":
+    # "SparkLauncherTrace" in driver.json. The wordcount job of
+    # SparkTrace only runs if the service sets "runjob": true, or if
+    # the launcher fails.
+
+    def Run(self):
+        if SERVICES[self.svckey].get('runjob'):
+            return SparkTrace.Run(self)
+
+        if not os.path.isdir(WORKDIR):
+            os.makedirs(WORKDIR)
+        self.workdir = tempfile.mkdtemp(
+            prefix='%s.' % self.svckey, dir=WORKDIR)
+
+        if not self.launchercommand():
+            LOG.info("%s - spark launcher failed, running the spark job", self.svckey)
+            return SparkTrace.Run(self)
+
+        cpr = javaClasspathReducer(self.classpath)
+        self.jars = [x for x in cpr.jars]
+        self.jarfiles = self.jars
+        self.sitexmls = []
+        for cpd in self.classpath.split(':'):
+            if os.path.isdir(cpd):
+                self.sitexmls += glob.glob(os.path.join(cpd, '*.xml'))
+
+        # the classes spark-submit loads, for --appcds and the classpath
+        # order, without a SparkContext
+        LOG.debug("%s - [-verbose:class]", self.svckey)
+        javacmd = list(self.javacmd)
+        idx = javacmd.index('-cp')
+        del javacmd[idx:idx + 2]
+        vrc, rawdataj = javaverbose(self.options, self.classpath, javacmd, [],
+                                    svckey=self.svckey, workdir=self.workdir)
+        self.classpaths = parseverboseoutput(rawdataj)
+        self.fqns = self.classpaths
+
+        self.rc_strace = 0
+        self.rc_verbose = vrc
+        LOG.debug("%s - %s total jars", self.svckey, len(self.jars))
+        LOG.info("%s - finished", self.svckey)
+
+    @staticmethod
+    def findsparkhome(sparksubmit):
+        """ Find the spark install behind the spark-submit cli """
+
+        if os.environ.get('SPARK_HOME'):
+            return os.environ['SPARK_HOME']
+        cmdpath = getcmdpath(sparksubmit)
+        if not cmdpath:
+            return None
+
+        # parcels wrap the real spark-submit in another script
+        basedir = os.path.dirname(os.path.dirname(os.path.realpath(cmdpath)))
+        for home in [basedir,
+                     os.path.join(basedir, 'lib', 'spark2'),
+                     os.path.join(basedir, 'lib', 'spark')]:
+            if os.path.isfile(os.path.join(home, 'bin', 'load-spark-env.sh')):
+                return home
+        return None
+
+    def launchercommand(self):
+        """ Ask the launcher for the java command of a spark-submit """
+
+        sparkhome = SparkLauncherTrace.findsparkhome(SparkTrace.findsparksubmit())
+        if not sparkhome:
+            LOG.error("%s - unable to find the spark home", self.svckey)
+            return False
+
+        # spark 2+ ships a jars dir, spark 1 an assembly
+        if os.path.isdir(os.path.join(sparkhome, 'jars')):
+            launchcp = '"$SPARK_HOME/jars/*"'
+        else:
+            assembly = sorted(glob.glob(os.path.join(sparkhome, 'lib', 'spark-assembly*.jar')))
+            if not assembly:
+                LOG.error("%s - no spark jars found in %s", self.svckey, sparkhome)
+                return False
+            launchcp = assembly[0]
+
+        # mirror bin/spark-class up to the point where it runs the command
+        script = "#!/bin/bash\n"
+        script += "export SPARK_HOME=%s\n" % sparkhome
+        script += ". \"$SPARK_HOME/bin/load-spark-env.sh\"\n"
+        script += "if [ -n \"$JAVA_HOME\" ]; then\n"
+        script += "    RUNNER=\"$JAVA_HOME/bin/java\"\n"
+        script += "else\n"
+        script += "    RUNNER=java\n"
+        script += "fi\n"
+        script += "$RUNNER -Xmx128m -cp %s org.apache.spark.launcher.Main" % launchcp
+        script += " org.apache.spark.deploy.SparkSubmit --version\n"
+
+        fname = os.path.join(self.workdir, 'launcher.sh')
+        f = open(fname, 'w')
+        f.write(script)
+        f.close()
+
+        LOG.debug("%s - running the spark launcher", self.svckey)
+        (rc, so, se) = run_command("bash %s" % fname, cwd=self.workdir, checkrc=False)
+        if rc != 0:
+            for x in [x for x in str(se).split('\n') if x.strip()]:
+                LOG.error("%s - %s", self.svckey, x)
+            return False
+
+        # the command is printed as NUL separated arguments
+        JAVACMD = [x for x in str(so).split('\0') if x.strip()]
+        if not JAVACMD or '-cp' not in JAVACMD:
+            LOG.error("%s - no java command from the spark launcher", self.svckey)
+            return False
+        JAVACMD[-1] = JAVACMD[-1].rstrip('\n')
+
+        self.javacmd = JAVACMD
+        self.jre = JAVACMD[0]
+        self.classpath = JAVACMD[JAVACMD.index('-cp') + 1]
+        self.STRACED_CLASSPATH = self.classpath
+        return True
 
 
 ############################################################
@@ -2084,61 +2534,23 @@ class HcatAPITrace(Tracer):
     def locateJREandJDK(self):
         """ Locate the JRE and JDK """
 
-        jre = None
-        jdk = None
-        jar = None
-
-        # If hive doesn't know, then use the process table
+        # Hive's boot classpath lives inside the jre it runs with
+        hints = []
         if self.hiveinfo:
-            if 'system' not in self.hiveinfo:
-                x = [locatejdkbasedir()]
-            elif 'sun.boot.class.path' not in self.hiveinfo['system']:
-                x = [locatejdkbasedir()]
-            else:
-                if 'system' in self.hiveinfo:
-                    if 'sun.boot.class.path' in self.hiveinfo['system']:
-                        x = self.hiveinfo['system'][
-                            'sun.boot.class.path'].split(':')
-        else:
-            x = [locatejdkbasedir()]
-
-        x = sorted(set([os.path.dirname(y) for y in x if y]))
-
-        for y in x:
-            yparts = y.split("/")
-            ylen = len(yparts)
-            indexes = list(range(0, ylen + 1))
-            indexes = reversed(indexes)
-            for i in indexes:
-                thisdir = "/".join(yparts[:i])
-
-                if not jre:
-                    cmd = "find %s -type f -name 'java'" % thisdir
-                    (rc, so, se) = run_command(cmd)
-                    if rc == 0:
-                        jre = so.strip().split('\n')[0]
-
-                if not jdk:
-                    cmd = "find %s -type f -name 'javac'" % thisdir
-                    (rc, so, se) = run_command(cmd)
-                    if rc == 0:
-                        jdk = so.strip()
-
-                if not jar:
-                    cmd = "find %s -type f -name 'jar'" % thisdir
-                    (rc, so, se) = run_command(cmd)
-                    if rc == 0:
-                        jar = so.strip()
-
-                if jre and jdk and jar:
-                    break
+            bootcp = self.hiveinfo.get('system', {}).get('sun.boot.class.path')
+            if bootcp:
+                hints = [x for x in bootcp.split(':') if x]
+        if self.jre:
+            hints.append(self.jre)
+
+        (jre, jdk, jar) = locatejdk(hints)
 
         LOG.debug("hcatapi - jres: %s", jre)
         LOG.debug("hcatapi - jdks: %s", jdk)
         LOG.debug("hcatapi - jars: %s", jar)
         return jre, jdk, jar
 
-    def findAllWebHcatJars(self, workdir=WORKDIR):
+    def findAllWebHcatJars(self, workdir=None):
         """ Current revisions of hcatalog are a subproject of hive and the relevant
             jars can be found in $hivehome/hcatalog """
 
@@ -2152,6 +2564,8 @@ class HcatAPITrace(Tracer):
         # exception for "too many open files". That is why this filters just the
         # hive|hcatalog jars and -HOPES- to get enough to compile the java client code
         if not hasattr(self, 'hiveinfo'):
+            if not workdir:
+                workdir = WORKDIR
             self.hiveinfo = collecthiveinfo(workdir=workdir)
         basecp = self.hiveinfo.get('env', {}).get('CLASSPATH', {})
         paths = []
@@ -2290,14 +2704,10 @@ class HcatAPITrace(Tracer):
         # /opt/.../hive-webhcat-0.13.1-cdh5.2.0.jar org.apache.hive.hcatalog.templeton.Main
 
         jarpaths = []
-        cmd = "ps aux | fgrep -i webhcat"
-        (rc, so, se) = run_command(cmd, checkrc=False, cwd=None)
-        if rc != 0:
-            return None
-
-        lines = [x for x in so.split('\n') if 'java' in x]
-        for line in lines:
-            parts = line.split()
+        procs = [x for x in processtable().with_arg('webhcat')
+                 if 'java' in ' '.join(x['argv'])]
+        for proc in procs:
+            parts = proc['argv']
             thisjar = None
 
             runjar_idx = None
@@ -2350,49 +2760,11 @@ class HcatAPITrace(Tracer):
         s = Template(SERVICES['hcatapi']['code'])
         tdata = s.substitute(thrift_uri=self.thrifturi)
 
-        fname = os.path.join(self.workdir, "TestHCatClient.java")
-        f = open(fname, "w")
-        f.write(tdata)
-        f.close()
-
-        # Chop up the classpath into multiple lines to avoid max command lengths
-        BASHCP = ""
-        CPS = [x for x in self.aclasspath.split(':') if x]
-        for idx, x in enumerate(CPS):
-            if idx == 0:
-                BASHCP = 'export CLASSPATH="%s"\n' % x
-            else:
-                BASHCP += 'export CLASSPATH="$CLASSPATH:%s"\n' % x
-
-        bscript = "#!/bin/bash\n"
-        bscript += BASHCP
-        bscript += "export CLASSPATH=\"$CLASSPATH\":$(hadoop classpath)\n"
-        bscript += "rm -rf htest_classes\n"
-        bscript += "mkdir htest_classes\n"
-        bscript += "%s -Xlint:deprecation -d htest_classes -g" % self.jdk
-        bscript += " TestHCatClient.java\n"
-        bscript += "RC=$?\n"
-        bscript += "if [ $RC != 0 ];then\n"
-        bscript += "    exit 1\n"
-        bscript += "fi\n"
-        bscript += "RC=$?\n"
-        bscript += "rm -f hts-hcat.jar\n"
-        bscript += "%s -cvf hts-hcat.jar -C htest_classes .\n" % self.jar
-        bscript += "if [ $RC != 0 ];then\n"
-        bscript += "    exit 1\n"
-        bscript += "fi\n"
-
-        bname = os.path.join(self.workdir, "make.sh")
-        f = open(bname, "w")
-        f.write(bscript)
-        f.close()
-        st = os.stat(bname)
-        os.chmod(bname, st.st_mode | stat.S_IEXEC)
-
-        cmd = "./make.sh"
-        (rc, so, se) = run_command(cmd, cwd=self.workdir)
-
+        classpath = [x for x in self.aclasspath.split(':') if x]
+        classpath += hadoopclasspathcmd()
         jarf = os.path.join(self.workdir, "hts-hcat.jar")
+        (rc, so, se) = compile_probe(
+            'hts-hcat', {'TestHCatClient.java': tdata}, classpath, self.jdk, jarf)
 
         if os.path.isfile(jarf) and rc == 0:
             return True
@@ -2410,15 +2782,11 @@ class HcatAPITrace(Tracer):
 
         LOG.debug("hcatapi - running test jar")
 
-        # Chop up the classpath into multiple lines to avoid max command lengths
-        BASHCP = ""
+        # Pass the classpath through a launcher jar to avoid max command lengths
         CPS = [x for x in self.aclasspath.split(':') if x]
-        for idx, x in enumerate(CPS):
-            if idx == 0:
-                BASHCP = 'export CLASSPATH="%s"\n' % x
-            else:
-                BASHCP += 'export CLASSPATH="$CLASSPATH:%s"\n' % x
-        BASHCP += 'export CLASSPATH="$CLASSPATH:$(pwd)/hts-hcat.jar"\n'
+        CPS.append(os.path.join(self.workdir, 'hts-hcat.jar'))
+        BASHCP = classpath_export(
+            os.path.join(self.workdir, 'test-classpath.jar'), CPS)
 
         testscr = "#!/bin/bash\n"
         testscr += BASHCP
@@ -2516,15 +2884,20 @@ class ThriftTrace(Tracer):
         hive_classpath = hive_dirs + hive_jars
         LOG.debug("thrift - hiveclasspath: %s", len(hive_classpath))
 
-        # Chop up the classpath into multiple lines to avoid max command
+        # Build the probe once, the makefile then only has to run it
+        probejar = os.path.join(self.workdir, 'thrift-probe.jar')
+        (rc, so, se) = compile_probe(
+            'thrift', {'ThriftExceptionFinder.java': THRIFTCODE},
+            hive_classpath, self.jdk, probejar)
+        if rc != 0:
+            LOG.error("thrift - %s", so + se)
+            return None, None
+
+        # Pass the classpath through a launcher jar to avoid max command
         # lengths
-        BASHCP = ""
-        for idx, x in enumerate(hive_classpath):
-            if idx == 0:
-                BASHCP = 'export CLASSPATH="%s"\n' % x
-            else:
-                BASHCP += 'export CLASSPATH="$CLASSPATH:%s"\n' % x
-        BASHCP += 'export CLASSPATH="$CLASSPATH:$(pwd)/."\n'
+        BASHCP = classpath_export(
+            os.path.join(self.workdir, 'thrift-classpath.jar'),
+            hive_classpath + [self.workdir, probejar])
 
         # Templatize and replace the build script ...
         ddict = {'CODE': THRIFTCODE,
@@ -2580,6 +2953,7 @@ class ThriftTrace(Tracer):
             if self.jars:
                 self.jars = [
                     x for x in Tracer.jrejarfilter(self.jre, self.jars)]
+                self.jars = [x for x in self.jars if not x.startswith(self.workdir)]
 
         if texceptionjar:
             LOG.debug(
@@ -2617,12 +2991,9 @@ class OozieTrace(Tracer):
     def findOozieProcess(self):
         """ Find an Oozie Process """
 
-        cmd = "ps aux"
-        (rc, so, se) = run_command(cmd)
-        lines = [x for x in so.split('\n') if x]
-        lines = [x for x in lines if 'oozie.config.dir' in x]
-        if len(lines) >= 1:
-            parts = shlex.split(lines[0])
+        procs = processtable().with_arg('oozie.config.dir')
+        if len(procs) >= 1:
+            parts = procs[0]['argv']
             for part in parts:
                 if part.startswith('-D') and '=' in part:
                     part = part.replace('-D', '', 1)
@@ -2831,15 +3202,14 @@ class PigTrace(Tracer):
         f = open(fname, "w")
         f.write(self.DATA)
         f.close()
-        # Clean and create other hdfs tmpdir
-        cmd = "hadoop fs -rm -r -f -skipTrash /tmp/%stracer.%s" % (self.svckey, info['username'])
-        (rc, so, se) = run_command(cmd)
-        cmd = "hadoop fs -mkdir -p /tmp/%stracer.%s/indata" % (self.svckey, info['username'])
-        (rc, so, se) = run_command(cmd)
-
-        # Copy the dataset to hdfs
-        cmd = "hadoop fs -copyFromLocal %s /tmp/%stracer.%s/indata/test.csv" % (fname, self.svckey, info['username'])
-        (rc, so, se) = run_command(cmd)
+        # Clean and create other hdfs tmpdir, then copy the dataset to hdfs
+        hdir = "/tmp/%stracer.%s" % (self.svckey, info['username'])
+        stager = HdfsStager(self.svckey, self.workdir,
+                            jdk=Tracer.get_jdk_jre_jar_commands()[0])
+        stager.rm(hdir)
+        stager.mkdir("%s/indata" % hdir)
+        stager.put([fname], "%s/indata/test.csv" % hdir)
+        stager.run()
 
         # Write out the example code
         s = Template(self.CODE)
@@ -2860,8 +3230,8 @@ class PigTrace(Tracer):
         if self.svckey is not None and 'pighcat' in self.svckey:
             cmd = "%s -e '%s'" % (hcat, SERVICES['pighcat']['post'])
             (rc, so, se) = run_command(cmd)
-        cmd = "hadoop fs -rm -r -f -skipTrash /tmp/%stracer.%s" % (self.svckey, info['username'])
-        (rc, so, se) = run_command(cmd)
+        stager.rm(hdir)
+        stager.run()
 
 
 ############################################################
@@ -2979,62 +3349,39 @@ class CheckNative(Tracer):
                 self.options, self.workdir, True, "5s", scmd)
             smap[cparts[0]] = map
 
-        for k, v in smap.items():
+        # the probes only use the jdk, so build them all with one javac
+        sources = {}
+        for k in smap.keys():
             classname = k.title() + "Native"
             ddict = {'classname': classname, 'library': k}
             s = Template(CHECKNATIVE_TEMPLATE)
-            code = s.substitute(ddict)
+            sources['%s.java' % classname] = s.substitute(ddict)
+        probejar = os.path.join(self.workdir, 'checknative-probe.jar')
+        (rc, so, se) = compile_probe('checknative', sources, [], self.jdk, probejar)
+        if rc != 0:
+            LOG.error("checknative build failed [%s]: %s %s", rc, so.strip(), se.strip())
+            smap = {}
 
-            (rc, so, se) = self.compilejava(classname, v, code)
+        for k, v in smap.items():
+            classname = k.title() + "Native"
+            (rc, so, se) = self.runjava(classname, v, probejar)
             print(k, rc, so.strip(), se.strip())
 
         self.rc_strace = 0
         self.rc_verbose = 0
 
-    def compilejava(self, classname, javamap, javacode):
-        """ Write out the Java file """
-        # write out the java file
-        jfile = os.path.join(self.workdir, "%s.java" % classname)
-        f = open(jfile, "w")
-        f.write(javacode)
-        f.close()
-
-        # compile the code
-        makefile = os.path.join(self.workdir, 'build_%s.sh' % classname)
-        f = open(makefile, "w")
-        f.write("#!/bin/bash\n")
-
-        f.write("export CLASSPATH=\"\"\n")
-        for j in javamap['classdirs']:
-            f.write("export CLASSPATH=\"$CLASSPATH:%s\"\n" % j)
-        for j in javamap['classjars']:
-            f.write("export CLASSPATH=\"$CLASSPATH:%s\"\n" % j)
-
-        f.write("%s \\" % self.jdk)
-        f.write("\n")
-        f.write(" %s.java\n" % (classname))
-        f.write("RC=$?\n")
-        f.write("if [ $RC != 0 ]; then\n")
-        f.write("   exit $RC\n")
-        f.write("fi\n")
-        f.close()
+    def runjava(self, classname, javamap, probejar):
+        """ Run the compiled class with the traced classpath """
 
-        cmd = "bash build_%s.sh" % classname
-        (rc, so, se) = run_command(cmd, cwd=self.workdir)
-        if rc != 0:
-            LOG.error("%s build failed", classname)
-            return (rc, so, se)
+        cpjar = os.path.join(self.workdir, '%s-classpath.jar' % classname)
+        cpentries = [probejar] + javamap['classdirs'] + javamap['classjars']
 
         # run the code
         makefile = os.path.join(self.workdir, 'run_%s.sh' % classname)
         f = open(makefile, "w")
         f.write("#!/bin/bash\n")
 
-        f.write("export CLASSPATH=\"\"\n")
-        for j in javamap['classdirs']:
-            f.write("export CLASSPATH=\"$CLASSPATH:%s\"\n" % j)
-        for j in javamap['classjars']:
-            f.write("export CLASSPATH=\"$CLASSPATH:%s\"\n" % j)
+        f.write(classpath_export(cpjar, cpentries))
 
         f.write("%s\\" % self.jre)
         f.write("\n")
@@ -3377,25 +3724,24 @@ def exclude_packages(classpath, excludepackages, shorten=False):
 
 def locatejdkbasedir():
     ''' use the process table to find a valid JDK path '''
+    return prefetchcontext().get('jdkbasedir', findjdkbasedir)
+
+
+def findjdkbasedir():
+    ''' Look for a running java whose bin dir also has javac and jar '''
 
     jres = []
     jdks = []
 
-    cmd = "ps aux | fgrep -i java"
-    (rc, so, se) = run_command(cmd, checkrc=False)
-    if rc != 0:
-        return None
-
-    # split apart the lines and find running jres
-    lines = so.split('\n')
-    for line in lines:
-        parts = shlex.split(line)
-        if len(parts) < 10:
+    # find running jres
+    for proc in processtable().by_exe('java'):
+        jre = proc['argv'][0]
+        if not jre.endswith('bin/java'):
+            jre = proc['exe']
+        if not jre.endswith('bin/java'):
             continue
-        if not parts[10].endswith('bin/java'):
-            continue
-        if os.path.isfile(parts[10]) and not parts[10] in jres:
-            jres.append(parts[10])
+        if os.path.isfile(jre) and jre not in jres:
+            jres.append(jre)
 
     # append a 'c' to the jre and see if it's a real file
     for jre in jres:
@@ -3411,8 +3757,103 @@ def locatejdkbasedir():
     return jdks[0]
 
 
+def javahome_candidates(hints=None):
+    """ Directories that may be a java home, most specific first """
+
+    candidates = []
+
+    # ancestors of known java paths, e.g. a traced jre or boot classpath
+    for hint in hints or []:
+        path = os.path.dirname(os.path.realpath(hint))
+        while path and path != '/':
+            candidates.append(path)
+            path = os.path.dirname(path)
+
+    if os.environ.get('JAVA_HOME'):
+        candidates.append(os.environ['JAVA_HOME'])
+
+    for cmd in ['javac', 'java']:
+        for bindir in os.environ.get('PATH', '').split(':'):
+            cmdpath = os.path.join(bindir, cmd)
+            if bindir and os.path.isfile(cmdpath):
+                cmdpath = os.path.realpath(cmdpath)
+                candidates.append(os.path.dirname(os.path.dirname(cmdpath)))
+                break
+
+    for proc in processtable().by_exe('java'):
+        if proc['exe'].endswith('bin/java'):
+            candidates.append(os.path.dirname(os.path.dirname(proc['exe'])))
+
+    for root in JAVAINSTALLROOTS:
+        candidates += sorted(glob.glob(root), reverse=True)
+
+    seen = set()
+    homes = []
+    for x in candidates:
+        if x not in seen:
+            seen.add(x)
+            homes.append(x)
+    return homes
+
+
+def locatejdk(hints=None):
+    """ Find the java, javac and jar commands with stat checks only """
+
+    key = tuple(hints or [])
+    if key in JDKCACHE:
+        return JDKCACHE[key]
+
+    def tool(home, name):
+        path = os.path.join(home, 'bin', name)
+        if os.path.isfile(path) and os.access(path, os.X_OK):
+            return path
+        return None
+
+    jre = None
+    jdk = None
+    jar = None
+    for home in javahome_candidates(hints):
+        hjre = tool(home, 'java')
+        hjdk = tool(home, 'javac')
+        hjar = tool(home, 'jar')
+        # a complete jdk beats tools collected from different homes
+        if hjre and hjdk and hjar:
+            (jre, jdk, jar) = (hjre, hjdk, hjar)
+            break
+        jre = jre or hjre
+        jdk = jdk or hjdk
+        jar = jar or hjar
+
+    JDKCACHE[key] = (jre, jdk, jar)
+    return JDKCACHE[key]
+
+
+def file_digest(path):
+    """ sha256 hex digest of a file, computed once per run """
+
+    if path not in DIGESTS:
+        sha = hashlib.sha256()
+        try:
+            f = open(path, 'rb')
+            try:
+                for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                    sha.update(chunk)
+            finally:
+                f.close()
+            DIGESTS[path] = sha.hexdigest()
+        except (IOError, OSError) as e:
+            LOG.debug("digest - unable to read %s: %s", path, e)
+            DIGESTS[path] = None
+    return DIGESTS[path]
+
+
 def hadoopclasspathcmd():
     """ Find all jars listed by the hadoop classpath command """
+    return prefetchcontext().get('hadoop classpath', listhadoopclasspath)
+
+
+def listhadoopclasspath():
+    """ Run the hadoop classpath command and expand it to jars """
 
     LOG.debug("hadoop-classpath - locating all jars")
 
@@ -3424,7 +3865,7 @@ def hadoopclasspathcmd():
         return jars
 
     # Split and iterate each path
-    paths = so.split(':')
+    paths = so.strip().split(':')
     for path in paths:
         files = glob.glob(path)
         for file in files:
@@ -3570,17 +4011,20 @@ def bashtimeout(workdir=WORKDIR, timeout=TIMEOUT):
 def run_command(cmd, checkrc=False, cwd=None, timeout=TIMEOUT):
     """ Run a shell command """
 
-    timeoutcmd = None
-    if checkcmdinpath('timeout'):
-        timeoutcmd = getcmdpath('timeout')
-        cmd = "%s -s SIGKILL %s %s" % (timeoutcmd, timeout, cmd)
+    if SESSIONTIMEOUTS:
+        (rc, so, se) = run_in_session(cmd, cwd=cwd, timeout=timeout)
     else:
-        btimeoutcmd = bashtimeout()
-        cmd = "%s %s" % (btimeoutcmd, cmd)
+        timeoutcmd = None
+        if checkcmdinpath('timeout'):
+            timeoutcmd = getcmdpath('timeout')
+            cmd = "%s -s SIGKILL %s %s" % (timeoutcmd, timeout, cmd)
+        else:
+            btimeoutcmd = bashtimeout()
+            cmd = "%s %s" % (btimeoutcmd, cmd)
 
-    p = Popen(cmd, cwd=cwd, stdout=PIPE, stderr=PIPE, shell=True)
-    so, se = p.communicate()
-    rc = p.returncode
+        p = Popen(cmd, cwd=cwd, stdout=PIPE, stderr=PIPE, shell=True)
+        so, se = p.communicate()
+        rc = p.returncode
     if str(sys.version).startswith('3'):
         so = so.decode("utf-8")
         se = se.decode('utf-8')
@@ -3592,6 +4036,30 @@ def run_command(cmd, checkrc=False, cwd=None, timeout=TIMEOUT):
     return rc, so, se
 
 
+def run_in_session(cmd, cwd=None, timeout=TIMEOUT, stderr=PIPE):
+    """ Run a shell command in its own session, kill the session on timeout """
+
+    # Killing only the shell or a timeout wrapper leaves the jvms it
+    # started running. Every descendant stays in the new session, so the
+    # whole tree can be found and killed through /proc.
+    p = Popen(cmd, cwd=cwd, stdout=PIPE, stderr=stderr, shell=True,
+              start_new_session=True)
+    try:
+        so, se = p.communicate(timeout=timeout_seconds(timeout))
+        return p.returncode, so, se
+    except subprocess.TimeoutExpired:
+        LOG.debug("killing session %s after %s: %s", p.pid, timeout, cmd)
+        kill_session(p.pid)
+
+    try:
+        so, se = p.communicate(timeout=5)
+    except subprocess.TimeoutExpired:
+        # something outside the session holds the pipes open
+        p.kill()
+        so, se = (b'', b'')
+    return 137, so, se
+
+
 def run_command_live(
         args, cwd=None,
         shell=True,
@@ -3654,8 +4122,6 @@ def get_hadoop_classpath(rawtext):
 def parse_strace_output(rawtext, shorten=False):
     """ Pull java related information from raw strace output """
 
-    CLASSPATH = None
-    JRE = None
     JAVACMD = None
     # JAVACMD_IDX = None
     JAVAENV = None
@@ -3686,6 +4152,15 @@ def parse_strace_output(rawtext, shorten=False):
     if not isinstance(JAVACMD, list):
         return None, None, None, None
 
+    return java_command_info(JAVACMD, JAVAENV, shorten=shorten)
+
+
+def java_command_info(JAVACMD, JAVAENV, shorten=False):
+    """ Get the jre and classpath of a captured java command """
+
+    CLASSPATH = None
+    JRE = None
+
     CPS = [x for x in JAVAENV if x.startswith('CLASSPATH=')]
     if CPS:
         CLASSPATH = CPS[0]
@@ -3714,6 +4189,579 @@ def parse_strace_output(rawtext, shorten=False):
     return JRE, CLASSPATH, JAVACMD, JAVAENV
 
 
+def java_config_files(JAVACMD):
+    """ List the config files and conf dir site xmls named by -D options """
+
+    files = []
+    for x in JAVACMD:
+        if not x.startswith('-D') or '=' not in x:
+            continue
+        value = x.split('=', 1)[1]
+        if os.path.isfile(value) and value.endswith(ProcWatcher.OPENFILES):
+            files.append(value)
+        elif os.path.isdir(value) and x[2:].split('=', 1)[0].endswith(('conf.dir', 'config.dir')):
+            files.extend(sorted(glob.glob(os.path.join(value, '*-site.xml'))))
+    return files
+
+
+def capture_backend(options, svckey):
+    """ Pick the exec capture backend for a service """
+
+    backend = None
+    svc = SERVICES.get(svckey)
+    if isinstance(svc, dict):
+        backend = svc.get('backend')
+    if options.backend:
+        backend = options.backend
+    if backend not in CAPTUREBACKENDS:
+        if backend:
+            LOG.error("%s - unknown backend %s, using strace", svckey, backend)
+        backend = 'strace'
+    return backend
+
+
+def dry_capture(cmd, cwd=None, timeout=TIMEOUT, workdir=WORKDIR):
+    """ Capture the java command of a launcher without starting java """
+
+    # A stub java is put first on the PATH and in JAVA_HOME. It records
+    # each call's argv and environment and exits, so the launcher script
+    # runs to completion in a second or two and nothing contacts the
+    # cluster. Launchers that hardcode JAVA_HOME in their env scripts
+    # start the real jvm instead, which the watcher kills as soon as it
+    # has its argv and environment. Failing both the launcher's own
+    # classpath subcommand is asked.
+    stubhome = tempfile.mkdtemp(prefix='dryjava.', dir=workdir)
+    try:
+        os.makedirs(os.path.join(stubhome, 'bin'))
+        callfile = os.path.join(stubhome, 'calls')
+        stub = os.path.join(stubhome, 'bin', 'java')
+        f = open(stub, 'w')
+        f.write("#!/bin/bash\n")
+        f.write("{ printf '%%s\\0' \"$@\"; printf '\\1'; env -0; printf '\\2'; } >> %s\n" % callfile)
+        f.write("exit 0\n")
+        f.close()
+        os.chmod(stub, 0o755)
+
+        # the java the launcher would have used without the stub
+        realjava = 'java'
+        if os.environ.get('JAVA_HOME'):
+            realjava = os.path.join(os.environ['JAVA_HOME'], 'bin', 'java')
+        elif checkcmdinpath('java'):
+            realjava = getcmdpath('java')
+
+        pw = ProcWatcher('env JAVA_HOME=%s PATH=%s:$PATH %s' % (
+            stubhome, os.path.join(stubhome, 'bin'), cmd),
+            cwd=cwd, timeout=timeout, interval=0.01, openfiles=False, killjava=True)
+        (rc, rawdata) = pw.run()
+
+        data = None
+        if os.path.isfile(callfile):
+            f = open(callfile, 'rb')
+            data = f.read()
+            f.close()
+            if str(sys.version).startswith('3'):
+                data = data.decode('utf-8', 'replace')
+    finally:
+        shutil.rmtree(stubhome, ignore_errors=True)
+
+    # keep the last call that is not a launcher probe, like
+    # parse_strace_output keeps the last execve
+    JAVACMD = None
+    for call in reversed([x for x in (data or '').split('\2') if x]):
+        (argv, environ) = call.split('\1', 1)
+        argv = [realjava] + argv.split('\0')[:-1]
+        if java_probe_call(argv):
+            LOG.debug("skipping launcher probe %s", ' '.join(argv))
+            continue
+        JAVACMD = argv
+        environ = [x for x in environ.split('\0') if x]
+        break
+    javas = [x for x in pw.javas.values() if not java_probe_call(x[1])]
+
+    if JAVACMD:
+        pass
+    elif javas:
+        LOG.debug("the launcher bypassed the stub java, the jvm was stopped at its start")
+        last = sorted(javas, key=lambda x: x[0])[-1]
+        JAVACMD = last[1]
+        environ = last[2]
+    else:
+        classpath = launcher_classpath(cmd)
+        if not classpath:
+            return rc, rawdata, (None, None, None, None), []
+        JAVACMD = [realjava]
+        environ = ['CLASSPATH=' + classpath]
+
+    JAVAENV = []
+    for x in environ:
+        if x.startswith('JAVA_HOME='):
+            if x[10:] == stubhome:
+                if os.environ.get('JAVA_HOME'):
+                    JAVAENV.append('JAVA_HOME=' + os.environ['JAVA_HOME'])
+                continue
+        if x.startswith('PATH='):
+            paths = x[5:].split(':')
+            x = 'PATH=' + ':'.join([y for y in paths if not y.startswith(stubhome)])
+        JAVAENV.append(x)
+
+    # the jvm never ran, so the only known config files are its options
+    opened = java_config_files(JAVACMD)
+
+    return rc, rawdata, java_command_info(JAVACMD, JAVAENV), opened
+
+
+def java_main_class(argv):
+    """ The main class (or -jar file) of a java argv, None if there is none """
+
+    args = argv[1:]
+    while args:
+        arg = args.pop(0)
+        if arg in ('-cp', '-classpath', '--class-path', '--module-path', '-p'):
+            if args:
+                args.pop(0)
+        elif arg == '-jar':
+            if args:
+                return args[0]
+            return None
+        elif not arg.startswith('-'):
+            return arg
+    return None
+
+
+def java_probe_call(argv):
+    """ True for the java calls a launcher makes before its real one """
+
+    for arg in argv[1:]:
+        if arg in JAVAPROBEOPTIONS:
+            return True
+    mainclass = java_main_class(argv)
+    if not mainclass:
+        return True
+    return mainclass in JAVAPROBECLASSES
+
+
+def launcher_classpath(cmd):
+    """ Ask the launcher of a command for its classpath """
+
+    try:
+        args = shlex.split(cmd)
+    except ValueError:
+        return None
+    for arg in args:
+        subcmd = CLASSPATHLAUNCHERS.get(os.path.basename(arg))
+        if subcmd:
+            (dirs, jars) = Tracer.run_and_parse_classpath(cmd="%s %s" % (arg, subcmd))
+            return ':'.join(dirs + jars)
+    return None
+
+
+############################################################
+#   /PROC HELPERS
+############################################################
+
+def timeout_seconds(timeout):
+    """ Convert a timeout(1) duration like 180s or 3m to seconds """
+
+    timeout = str(timeout).strip()
+    units = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+    if timeout and timeout[-1] in units:
+        return float(timeout[:-1]) * units[timeout[-1]]
+    return float(timeout)
+
+
+def proc_read(pid, name):
+    """ Read a /proc/<pid> file, None if the process is gone """
+
+    try:
+        f = open('/proc/%s/%s' % (pid, name), 'rb')
+        data = f.read()
+        f.close()
+    except (IOError, OSError):
+        return None
+    if str(sys.version).startswith('3'):
+        data = data.decode('utf-8', 'replace')
+    return data
+
+
+def proc_pids():
+    """ List the pids in /proc """
+
+    return [int(x) for x in os.listdir('/proc') if x.isdigit()]
+
+
+def proc_stat(pid):
+    """ Return the (ppid, pgid, sid, starttime) of a process """
+
+    data = proc_read(pid, 'stat')
+    if not data:
+        return None
+    # the command name may contain spaces, so split after its ')'
+    fields = data.rsplit(')', 1)[1].split()
+    return (int(fields[1]), int(fields[2]), int(fields[3]), int(fields[19]))
+
+
+def proc_cmdline(pid):
+    """ Return the argv of a process """
+
+    data = proc_read(pid, 'cmdline')
+    if not data:
+        return None
+    return data.split('\0')[:-1]
+
+
+def proc_environ(pid):
+    """ Return the environment a process was started with """
+
+    data = proc_read(pid, 'environ')
+    if data is None:
+        return None
+    return [x for x in data.split('\0') if x]
+
+
+def proc_exe(pid):
+    """ Return the executable of a process """
+
+    try:
+        return os.readlink('/proc/%s/exe' % pid)
+    except OSError:
+        return None
+
+
+def proc_openfiles(pid):
+    """ Return the paths a process currently has open """
+
+    fddir = '/proc/%s/fd' % pid
+    try:
+        fds = os.listdir(fddir)
+    except OSError:
+        return []
+    paths = []
+    for fd in fds:
+        try:
+            path = os.readlink(os.path.join(fddir, fd))
+        except OSError:
+            continue
+        if path.startswith('/'):
+            paths.append(path)
+    return paths
+
+
+class ProcessTable(object):
+    """ A snapshot of the process table read from /proc """
+
+    def __init__(self):
+        self.procs = []
+        self.byexe = {}
+        for pid in proc_pids():
+            argv = proc_cmdline(pid)
+            if not argv:
+                # kernel threads and processes that just exited
+                continue
+            exe = proc_exe(pid)
+            proc = {'pid': pid,
+                    'exe': exe or argv[0],
+                    'argv': argv,
+                    'environ': proc_environ(pid)}
+            self.procs.append(proc)
+            for name in set([os.path.basename(proc['exe']), os.path.basename(argv[0])]):
+                self.byexe.setdefault(name, []).append(proc)
+
+    def by_exe(self, name):
+        """ Processes whose executable or argv[0] has this basename """
+        return self.byexe.get(name, [])
+
+    def with_arg(self, substring):
+        """ Processes with an argument containing this substring """
+        return [x for x in self.procs
+                if [y for y in x['argv'] if substring in y]]
+
+
+def processtable():
+    """ The process table snapshot shared by all tracers """
+
+    global PROCTABLE
+    if PROCTABLE is None:
+        PROCTABLE = ProcessTable()
+    return PROCTABLE
+
+
+def proc_children(pid):
+    """ List the children of a process, None if the kernel can not tell """
+
+    pids = []
+    try:
+        tasks = os.listdir('/proc/%s/task' % pid)
+    except OSError:
+        return []
+    for tid in tasks:
+        data = proc_read('%s/task/%s' % (pid, tid), 'children')
+        if data is None:
+            if os.path.isdir('/proc/%s' % pid):
+                return None
+            continue
+        pids.extend([int(x) for x in data.split()])
+    return pids
+
+
+def proc_descendants(pid):
+    """ List a session leader and its descendants """
+
+    # /proc/<pid>/task/<tid>/children needs CONFIG_PROC_CHILDREN, without
+    # it the whole session is looked up instead.
+    pids = []
+    todo = [pid]
+    while todo:
+        x = todo.pop(0)
+        children = proc_children(x)
+        if children is None:
+            return session_pids(pid)
+        pids.append(x)
+        todo.extend(children)
+    return pids
+
+
+def session_pids(sid):
+    """ List the live processes of a session """
+
+    pids = []
+    for pid in proc_pids():
+        data = proc_read(pid, 'stat')
+        if not data:
+            continue
+        fields = data.rsplit(')', 1)[1].split()
+        if fields[0] != 'Z' and int(fields[3]) == sid:
+            pids.append(pid)
+    return pids
+
+
+def kill_session(sid):
+    """ SIGKILL every process of a session and report the survivors """
+
+    for pid in session_pids(sid):
+        try:
+            os.kill(pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+    # give the kernel a moment to take them down
+    survivors = []
+    for i in range(10):
+        survivors = session_pids(sid)
+        if not survivors:
+            break
+        time.sleep(0.1)
+    for pid in survivors:
+        LOG.warning("process %s survived the timeout kill: %s",
+                    pid, ' '.join(proc_cmdline(pid) or []))
+    return survivors
+
+
+class ProcWatcher(object):
+    """ Run a command in its own session and watch for its java exec """
+
+    # Unlike strace nothing is attached to the processes, so the jvm runs
+    # at full speed and ptrace restrictions do not matter. The command's
+    # descendants are polled for java processes, their argv and
+    # environment are read once and, with openfiles, their open files on
+    # every pass until the command exits. Files a jvm opens and closes
+    # between two passes are missed. With killjava the session is killed
+    # as soon as a jvm other than a launcher probe is seen. timeout(1) moves itself to a new
+    # process group, the session is what a kill has to take down.
+
+    OPENFILES = ('site.xml', 'login.conf', 'mapr-clusters.conf')
+
+    def __init__(self, cmd, cwd=None, timeout=TIMEOUT, interval=0.02, openfiles=True,
+                 killjava=False):
+        self.cmd = cmd
+        self.cwd = cwd
+        self.timeout = timeout
+        self.interval = interval
+        self.openfiles = openfiles
+        self.killjava = killjava
+        self.javas = {}
+        self.opened = []
+
+    def run(self):
+        """ Run the command, return (rc, output) """
+
+        out = tempfile.TemporaryFile()
+        p = Popen(self.cmd, cwd=self.cwd, stdout=out, stderr=subprocess.STDOUT,
+                  shell=True, preexec_fn=os.setsid)
+        deadline = None
+        if self.timeout:
+            deadline = time.time() + timeout_seconds(self.timeout)
+
+        timedout = False
+        stopped = False
+        while p.poll() is None:
+            self.scan(p.pid)
+            if self.killjava and [x for x in self.javas.values() if not java_probe_call(x[1])]:
+                LOG.debug("killing session %s at its java start", p.pid)
+                kill_session(p.pid)
+                stopped = True
+                break
+            if deadline and time.time() > deadline:
+                LOG.debug("killing session %s after %s", p.pid, self.timeout)
+                kill_session(p.pid)
+                timedout = True
+                break
+            time.sleep(self.interval)
+        rc = p.wait()
+        if timedout:
+            rc = 137
+        elif stopped:
+            rc = 0
+
+        out.seek(0)
+        data = out.read()
+        out.close()
+        if str(sys.version).startswith('3'):
+            data = data.decode('utf-8', 'replace')
+        return rc, data
+
+    def scan(self, root):
+        """ Look at every descendant of the command once """
+
+        for pid in proc_descendants(root):
+            if pid in self.javas and not self.openfiles:
+                continue
+            pstat = proc_stat(pid)
+            if not pstat:
+                continue
+            exe = proc_exe(pid)
+            if not exe or not exe.endswith('/java'):
+                continue
+            if pid not in self.javas:
+                cmdline = proc_cmdline(pid)
+                environ = proc_environ(pid)
+                if cmdline and environ is not None:
+                    if not cmdline[0].endswith('java'):
+                        cmdline[0] = exe
+                    self.javas[pid] = (pstat[3], cmdline, environ)
+            if not self.openfiles:
+                continue
+            for x in proc_openfiles(pid):
+                if x.endswith(self.OPENFILES) and x not in self.opened:
+                    self.opened.append(x)
+
+    def javainfo(self):
+        """ The (JRE, CLASSPATH, JAVACMD, JAVAENV) of the last java started """
+
+        if not self.javas:
+            return (None, None, None, None)
+        last = sorted(self.javas.values(), key=lambda x: x[0])[-1]
+        return java_command_info(last[1], last[2])
+
+
+def proc_capture(cmd, cwd=None, timeout=TIMEOUT):
+    """ Capture the java command of a launcher from /proc """
+
+    pw = ProcWatcher(cmd, cwd=cwd, timeout=timeout)
+    rc, rawdata = pw.run()
+    javainfo = pw.javainfo()
+
+    # short lived opens slip between two polls, add the config files the
+    # jvm was pointed at
+    opened = list(pw.opened)
+    if javainfo[2]:
+        for x in java_config_files(javainfo[2]):
+            if x not in opened:
+                opened.append(x)
+    return rc, rawdata, javainfo, opened
+
+
+def strace_seconds(stamp):
+    """ Convert a strace -t/-tt HH:MM:SS[.usec] stamp to seconds """
+
+    try:
+        (h, m, sec) = stamp.split(':')
+        return int(h) * 3600 + int(m) * 60 + float(sec)
+    except ValueError:
+        return 0
+
+
+def strace_java_trace(prefix):
+    """ Return the pid and trace of the last java process from strace -ff -o files """
+
+    files = {}
+    for fname in glob.glob(prefix + '.*'):
+        pid = fname.rsplit('.', 1)[1]
+        if pid.isdigit():
+            files[int(pid)] = fname
+
+    # Find the java execve. A forked subshell may open a redirect before
+    # it execs java, so every line is looked at, only known helper
+    # programs are dropped after their first line. The -t stamps are
+    # compared in seconds since the start of the trace, which may cross
+    # midnight.
+    java = None
+    start = 0
+    if files:
+        f = open(files[min(files)], 'r')
+        first = f.readline().split()
+        f.close()
+        if first:
+            start = strace_seconds(first[0])
+    for pid in sorted(files.keys()):
+        f = open(files[pid], 'r')
+        line = f.readline()
+        m = STRACEEXECVE.search(line)
+        if m and os.path.basename(m.group(1)) in STRACELEAFCMDS:
+            f.close()
+            continue
+        lineno = 0
+        while line:
+            m = STRACEEXECVE.search(line)
+            if m and os.path.basename(m.group(1)) == 'java' \
+                    and line.strip().endswith('= 0'):
+                stamp = strace_seconds(line.split()[0])
+                if stamp < start:
+                    stamp += 86400
+                if not java or stamp >= java[0]:
+                    java = (stamp, pid, lineno)
+            line = f.readline()
+            lineno += 1
+        f.close()
+
+    if not java:
+        return None, ''
+
+    # Follow the jvm's threads and children from the exec onwards
+    lines = []
+    todo = [(java[1], java[2])]
+    seen = set()
+    while todo:
+        pid, start = todo.pop(0)
+        if pid in seen or pid not in files:
+            continue
+        seen.add(pid)
+        f = open(files[pid], 'r')
+        for idx, line in enumerate(f):
+            if idx < start:
+                continue
+            lines.append(line)
+            m = STRACECLONE.search(line)
+            if m:
+                todo.append((int(m.group(1)), 0))
+        f.close()
+
+    return java[1], '\n' + ''.join(lines)
+
+
+def strace_execve_line(stamp, argv, environ):
+    """ Format an argv and environment as a strace execve line """
+
+    def quote(x):
+        x = x.replace('\\', '\\\\').replace('"', '\\"')
+        x = x.replace('\n', '\\n').replace('\t', '\\t')
+        return '"%s"' % x
+
+    return '%s execve(%s, [%s], [%s]) = 0' % (
+        stamp, quote(argv[0]),
+        ', '.join([quote(x) for x in argv]),
+        ', '.join([quote(x) for x in environ]))
+
+
 def parse_strace_open_file(rawtext, filename, list=False):
     """ Return the last path a filename was opened from """
 
@@ -3756,6 +4804,172 @@ def parse_strace_open_file(rawtext, filename, list=False):
     return None
 
 
+def classpath_export(jarpath, classpath):
+    """ Export a classpath through a manifest-only launcher jar """
+
+    # Exporting the classpath one entry per line makes bash re-copy an
+    # ever growing string, while a single entry pointing at a jar whose
+    # manifest holds the classpath stays short no matter how many
+    # entries there are. Both java and javac follow the Class-Path.
+    if not isinstance(classpath, list):
+        classpath = classpath.split(':')
+
+    entries = []
+    for x in classpath:
+        x = x.strip()
+        if not x:
+            continue
+        if x.endswith('/*'):
+            # the manifest has no wildcards, expand them like java does
+            jars = glob.glob(x + '.jar') + glob.glob(x + '.JAR')
+            entries += sorted(jars)
+        else:
+            entries.append(os.path.abspath(x))
+
+    write_manifest_jar(jarpath, entries)
+    return 'export CLASSPATH="%s"\n' % jarpath
+
+
+def java_major_version(java):
+    """ The major version of a java or javac command, 8 for 1.8 """
+
+    # The release file in the JDK home is read first, only JDKs that do
+    # not ship one are asked with -version.
+    home = os.path.dirname(os.path.dirname(os.path.realpath(java)))
+    version = None
+    release = os.path.join(home, 'release')
+    if os.path.isfile(release):
+        f = open(release)
+        m = re.search(r'^JAVA_VERSION="([^"]+)"', f.read(), re.M)
+        f.close()
+        if m:
+            version = m.group(1)
+    if not version:
+        (rc, so, se) = run_command("%s -version" % java, checkrc=False)
+        m = re.search(r'version "([^"]+)"', str(so) + str(se))
+        if m:
+            version = m.group(1)
+    if not version:
+        return None
+    parts = re.findall(r'\d+', version)
+    if not parts:
+        return None
+    if parts[0] == '1' and len(parts) > 1:
+        return int(parts[1])
+    return int(parts[0])
+
+
+def jdk_fingerprint(jdk):
+    """ Identify a JDK without starting it """
+
+    # The release file in the JDK home names the exact version. Older
+    # JDKs do not ship one, so fall back to the javac binary itself.
+    javac = os.path.realpath(jdk)
+    release = os.path.join(os.path.dirname(os.path.dirname(javac)), 'release')
+    if os.path.isfile(release):
+        f = open(release, 'rb')
+        data = f.read()
+        f.close()
+        return javac + ':' + hashlib.sha256(data).hexdigest()
+    st = os.stat(javac)
+    return '%s:%s:%s' % (javac, st.st_size, int(st.st_mtime))
+
+
+def classpath_fingerprint(classpath):
+    """ Identify a classpath by the path, size and mtime of its entries """
+
+    if not isinstance(classpath, list):
+        classpath = classpath.split(':')
+
+    parts = []
+    for x in classpath:
+        x = x.strip()
+        if not x:
+            continue
+        if x.endswith('/*'):
+            paths = sorted(glob.glob(x + '.jar'))
+        else:
+            paths = [x]
+        for path in paths:
+            try:
+                st = os.stat(path)
+                parts.append('%s:%s:%s' % (path, st.st_size, int(st.st_mtime)))
+            except OSError:
+                parts.append('%s:-' % path)
+    return hashlib.sha256('\n'.join(parts).encode('utf-8')).hexdigest()
+
+
+def compile_probe(name, sources, classpath, jdk, dest, cachedir=None):
+    """ Compile java probe sources into a jar, reusing a cached build """
+
+    # Probes are keyed by their sources, the JDK and the compile
+    # classpath, so an unchanged probe never starts javac again. All
+    # sources of a probe are compiled by a single javac invocation and
+    # the jar is assembled here rather than by a second JVM.
+    if not cachedir:
+        cachedir = PROBECACHE
+    if not os.path.isdir(cachedir):
+        try:
+            os.makedirs(cachedir)
+        except OSError as e:
+            # build next to dest, the probe is then only cached for this run
+            LOG.debug("%s - unable to create the probe cache %s: %s", name, cachedir, e)
+            cachedir = os.path.dirname(os.path.abspath(dest))
+
+    key = hashlib.sha256()
+    for fn in sorted(sources.keys()):
+        key.update(fn.encode('utf-8'))
+        key.update(sources[fn].encode('utf-8'))
+    key.update(jdk_fingerprint(jdk).encode('utf-8'))
+    key.update(classpath_fingerprint(classpath).encode('utf-8'))
+    cached = os.path.join(cachedir, '%s-%s.jar' % (name, key.hexdigest()[:20]))
+
+    # parallel tracers may build the same probe, let one of them do it
+    lockf = open(cached + '.lock', 'w')
+    fcntl.flock(lockf, fcntl.LOCK_EX)
+    try:
+        if os.path.isfile(cached):
+            LOG.debug("%s - using the cached probe %s", name, cached)
+            shutil.copy(cached, dest)
+            return (0, '', '')
+
+        builddir = tempfile.mkdtemp(prefix='%s-build.' % name, dir=os.path.dirname(dest))
+        try:
+            classdir = os.path.join(builddir, 'classes')
+            os.makedirs(classdir)
+            for fn, code in sources.items():
+                f = open(os.path.join(builddir, fn), 'w')
+                f.write(code)
+                f.close()
+
+            cpjar = os.path.join(builddir, 'classpath.jar')
+            classpath_export(cpjar, classpath)
+            cmd = "%s -nowarn -g -d classes -cp %s %s" % (
+                jdk, cpjar, ' '.join(sorted(sources.keys())))
+            LOG.debug("%s - compiling the probe", name)
+            (rc, so, se) = run_command(cmd, cwd=builddir, checkrc=False)
+            if rc != 0:
+                return (rc, so, se)
+
+            tmpjar = cached + '.%s.tmp' % os.getpid()
+            zf = zipfile.ZipFile(tmpjar, 'w', zipfile.ZIP_DEFLATED)
+            zf.writestr('META-INF/MANIFEST.MF', 'Manifest-Version: 1.0\r\n\r\n')
+            for root, dirs, files in os.walk(classdir):
+                for fn in sorted(files):
+                    fpath = os.path.join(root, fn)
+                    zf.write(fpath, os.path.relpath(fpath, classdir))
+            zf.close()
+            os.rename(tmpjar, cached)
+        finally:
+            shutil.rmtree(builddir, ignore_errors=True)
+
+        shutil.copy(cached, dest)
+        return (rc, so, se)
+    finally:
+        fcntl.flock(lockf, fcntl.LOCK_UN)
+        lockf.close()
+
+
 def safequote(javacmd):
     """ Some JRE args need to be quoted """
 
@@ -3806,8 +5020,11 @@ def javaverbose(
     JAVACMD.insert(1, "-verbose:class")
 
     # add timeout only if the caller allows and not already
-    # part of the command
-    if usetimeout and not JAVACMD[0].endswith('/timeout'):
+    # part of the command, python 3 times out the whole session instead
+    sessiontimeout = None
+    if usetimeout and SESSIONTIMEOUTS and not options.verbose and not options.poll:
+        sessiontimeout = timeout
+    elif usetimeout and not JAVACMD[0].endswith('/timeout'):
         if checkcmdinpath('timeout') and piping:
             timeoutcmd = getcmdpath('timeout')
             # Set timeout on the command
@@ -3838,15 +5055,10 @@ def javaverbose(
     fname = fh.name
     fh.write("#!/bin/bash\n")
 
-    # Split the classpath export into multiple lines to avoid the
+    # Pass the classpath through a launcher jar to avoid the
     # max command line length limitations.
     if CLASSPATH:
-        CPS = CLASSPATH.split(':')
-        for idx, x in enumerate(CPS):
-            if idx == 0:
-                fh.write('export CLASSPATH="%s"\n' % x)
-            else:
-                fh.write('export CLASSPATH="$CLASSPATH:%s"\n' % x)
+        fh.write(classpath_export(fname + '-classpath.jar', CLASSPATH))
 
     fh.write(NEWCMD)
     fh.close()
@@ -3856,6 +5068,8 @@ def javaverbose(
         if options.poll:
             (rc, so, se) = run_command_live(
                 cmd, verbose=False, poll=options.poll, svckey=svckey)
+        elif sessiontimeout:
+            (rc, so, se) = run_in_session(cmd, cwd=WORKDIR, timeout=sessiontimeout)
         else:
             p = Popen(cmd, cwd=WORKDIR, stdout=PIPE, stderr=PIPE, shell=True)
             so, se = p.communicate()
@@ -3868,9 +5082,12 @@ def javaverbose(
 
         # Redirect the script to the filename
         cmd += " > %s 2>&1" % outfile
-        p = Popen(cmd, cwd=WORKDIR, shell=True)
-        so, se = p.communicate()
-        rc = p.returncode
+        if sessiontimeout:
+            (rc, so, se) = run_in_session(cmd, cwd=WORKDIR, timeout=sessiontimeout)
+        else:
+            p = Popen(cmd, cwd=WORKDIR, shell=True)
+            so, se = p.communicate()
+            rc = p.returncode
 
         # Read the outfile
         f = open(outfile, "rb")
@@ -3953,10 +5170,103 @@ def classpathstojars(classpaths):
     return jars
 
 
+def jar_version(jarfile):
+    """ Read the version a jar was built as from its own metadata """
+
+    if jarfile in JARVERSIONS:
+        return JARVERSIONS[jarfile]
+
+    def value(data, key, sep):
+        for line in data.decode('utf-8', 'replace').splitlines():
+            if line.startswith(key + sep):
+                thisv = line[len(key) + 1:].strip()
+                # unfiltered build properties are of no use
+                if thisv and '$' not in thisv:
+                    return thisv
+        return None
+
+    # shaded jars carry the version-info of what they bundle (hive-exec
+    # has hadoop's common-version-info), only the jar's own is trusted
+    (artifact, delimiter, fileversion) = \
+        Tracer.split_jar_name_and_version(os.path.basename(jarfile))
+    if not fileversion[:1].isdigit():
+        fileversion = ''
+    owninfo = ['%s-version-info.properties' % x for x in
+               artifact.replace('_', '-').split('-') if x]
+
+    version = None
+    try:
+        zf = zipfile.ZipFile(jarfile)
+        try:
+            names = zf.namelist()
+            # hadoop and its ecosystem record the exact build here
+            for name in names:
+                if name in owninfo:
+                    version = value(zf.read(name), 'version', '=')
+                    if version:
+                        break
+            if not version and fileversion:
+                version = fileversion
+            if not version and 'META-INF/MANIFEST.MF' in names:
+                data = zf.read('META-INF/MANIFEST.MF')
+                version = value(data, 'Implementation-Version', ':') or \
+                    value(data, 'Bundle-Version', ':')
+        finally:
+            zf.close()
+    except (IOError, OSError, zipfile.BadZipfile) as e:
+        LOG.debug("version - unable to read %s: %s", jarfile, e)
+        version = fileversion or None
+
+    JARVERSIONS[jarfile] = version
+    return version
+
+
+def jars_version(prefixes, jarfiles):
+    """ Version of a product from the metadata of its own jars """
+
+    candidates = []
+    for prefix in prefixes:
+        candidates = sorted(set(
+            [x for x in jarfiles if
+             os.path.basename(x) == prefix + '.jar' or
+             os.path.basename(x).startswith(prefix + '-')]))
+        if candidates:
+            break
+    if not candidates:
+        return None
+
+    pool = ThreadPool(min(8, len(candidates)))
+    try:
+        versions = pool.map(jar_version, candidates)
+    finally:
+        pool.close()
+        pool.join()
+
+    # the same product jar may be on the classpath more than once
+    counts = {}
+    for version in versions:
+        if version:
+            counts[version] = counts.get(version, 0) + 1
+    if not counts:
+        return None
+    return sorted(counts.items(), key=lambda x: (-x[1], x[0]))[0][0]
+
+
+def service_version(svckey, jarfiles):
+    """ Version of the product behind a service, from its traced jars """
+
+    family = service_family(svckey)
+    return jars_version(VERSIONJARS.get(family, [family]), jarfiles or [])
+
+
 def getversion(cmd, jarfiles):
-    """ Find --version for a cli """
+    """ Find the version for a cli """
 
-    version = _getversionstring(cmd)
+    # The jars already name their version in their metadata, which is
+    # far cheaper than starting a jvm for --version.
+    version = jars_version(VERSIONJARS.get(cmd, [cmd]), jarfiles)
+    if version is None:
+        version = _getversionstring(cmd)
 
     if version is None:
         jversions = []
@@ -4073,7 +5383,16 @@ def _getversionstring(cmd):
     return version
 
 
-def collecthiveinfo(workdir=WORKDIR, log=True, options=None):
+def collecthiveinfo(workdir=None, log=True, options=None):
+    """ Hive's active settings, collected once per run """
+    # main() replaces WORKDIR, so the default is looked up per call
+    if not workdir:
+        workdir = WORKDIR
+    return prefetchcontext().get(
+        ('hiveinfo', workdir), readhiveinfo, workdir, log)
+
+
+def readhiveinfo(workdir=WORKDIR, log=True):
     # Use hive's 'set -v' output to create a dict of active settings.
     #   runs as a singleton to reduce overall runtime
     # Also collect a list of tables in the default database.
@@ -4179,12 +5498,11 @@ def collecthiveinfo(workdir=WORKDIR, log=True, options=None):
 
 
 def commandinpstable(cmd):
-    """ Run fgrep and ps command """
+    """ Check if a running process was started as this command """
 
-    checkcmd = "ps aux | awk '{print $11}' | fgrep %s" % cmd
-    (rc, so, se) = run_command(checkcmd)
-    if rc == 0:
-        return True
+    for proc in processtable().procs:
+        if cmd in proc['argv'][0]:
+            return True
     return False
 
 
@@ -4389,18 +5707,470 @@ def xmlnametovalue(rawxml, name):
     return None
 
 
+class CopyPipeline(object):
+    """ Stage the files of each finished service while the others trace """
+
+    # Files are copied once, hashed on the way, into a content addressed
+    # staging dir next to the destination, so the final copy stage only
+    # has to link the files it keeps into place. The worker threads are
+    # only started by start(), after the tracer processes are forked,
+    # files added before that are queued.
+
+    def __init__(self, dest, workers=COPYWORKERS):
+        # files unchanged since the last run are reused, not staged
+        self.previous = Manifest(dest)
+        parent = os.path.dirname(os.path.abspath(dest))
+        if not os.path.isdir(parent):
+            os.makedirs(parent)
+        self.stagedir = tempfile.mkdtemp(
+            prefix=".%s.staging." % os.path.basename(os.path.abspath(dest)),
+            dir=parent)
+        self.workers = workers
+        self.pool = None
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.queued = []
+
+    def start(self):
+        """ Start the workers and the queued copies """
+
+        with self.lock:
+            if self.pool is None:
+                self.pool = ThreadPool(self.workers)
+                for key in self.queued:
+                    self.pending[key] = self.pool.apply_async(self.copy, (key,))
+                self.queued = []
+
+    def add(self, svckey, rdict):
+        """ Queue the jars and site xmls of a finished service """
+
+        files = (rdict.get('jarfiles') or []) + (rdict.get('sitexmls') or [])
+        files = [x for x in files if x and '/sas.' not in x]
+        LOG.debug("%s - staging %s files", svckey, len(files))
+        for src in files:
+            self.stage(src)
+
+    def stage(self, src):
+        """ Queue one file, once per real path """
+
+        key = os.path.realpath(src)
+        with self.lock:
+            if key in self.pending:
+                return
+            if self.pool is None:
+                self.pending[key] = None
+                self.queued.append(key)
+            else:
+                self.pending[key] = self.pool.apply_async(self.copy, (key,))
+
+    def copy(self, src):
+        """ Copy and hash a file in one read """
+
+        if not os.path.isfile(src) or self.previous.current(src):
+            return None
+        sha = hashlib.sha256()
+        size = 0
+        (fd, tmpfile) = tempfile.mkstemp(dir=self.stagedir)
+        try:
+            fout = os.fdopen(fd, 'wb')
+            fin = open(src, 'rb')
+            try:
+                for chunk in iter(lambda: fin.read(1024 * 1024), b''):
+                    sha.update(chunk)
+                    fout.write(chunk)
+                    size += len(chunk)
+            finally:
+                fin.close()
+                fout.close()
+            shutil.copymode(src, tmpfile)
+            # identical files end up as one staged copy
+            staged = os.path.join(self.stagedir, sha.hexdigest())
+            os.rename(tmpfile, staged)
+        except (IOError, OSError) as e:
+            LOG.debug("unable to stage %s: %s", src, e)
+            if os.path.isfile(tmpfile):
+                os.remove(tmpfile)
+            return None
+        DIGESTS[src] = sha.hexdigest()
+        return (staged, sha.hexdigest(), size)
+
+    def get(self, src):
+        """ Wait for the staged copy of a file, if it was queued """
+
+        self.start()
+        with self.lock:
+            result = self.pending.get(os.path.realpath(src))
+        if result is None:
+            return None
+        try:
+            return result.get()
+        except Exception as e:
+            LOG.debug("unable to stage %s: %s", src, e)
+            return None
+
+    def place(self, src, dst, link=True):
+        """ Put the staged copy of src at dst """
+
+        staged = self.get(src)
+        if not staged:
+            return False
+        copied = False
+        if link:
+            try:
+                os.link(staged[0], dst)
+                copied = True
+            except OSError:
+                pass
+        if not copied:
+            shutil.copy(staged[0], dst)
+        DIGESTS[dst] = staged[1]
+        return True
+
+    def close(self):
+        """ Stop the workers and drop the staged copies """
+
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+        shutil.rmtree(self.stagedir, ignore_errors=True)
+
+
+class Manifest(object):
+    """ What an output directory holds and where each file came from """
+
+    def __init__(self, dirpath):
+        self.dirpath = dirpath
+        self.files = {}
+        thisfile = os.path.join(dirpath, MANIFESTNAME)
+        if os.path.isfile(thisfile):
+            try:
+                f = open(thisfile)
+                self.files = json.load(f).get('files', {})
+                f.close()
+            except (IOError, OSError, ValueError, AttributeError) as e:
+                LOG.debug("unable to read %s: %s", thisfile, e)
+        self.bysource = {}
+        for relpath, entry in self.files.items():
+            self.bysource.setdefault(entry.get('source'), []).append(relpath)
+
+    def current(self, src):
+        """ A copy of src that is still identical to it, as (relpath, entry) """
+
+        src = os.path.realpath(src)
+        if src not in self.bysource:
+            return None
+        try:
+            st = os.stat(src)
+        except OSError:
+            return None
+        for relpath in sorted(self.bysource[src]):
+            entry = self.files[relpath]
+            if not os.path.isfile(os.path.join(self.dirpath, relpath)):
+                continue
+            if entry.get('size') != st.st_size:
+                continue
+            # a touched file is still reused when its content is the same
+            if entry.get('mtime') == st.st_mtime or \
+                    entry.get('sha256') == file_digest(src):
+                return (relpath, entry)
+        return None
+
+    def refresh(self, rehash=False):
+        """ Account for files written or edited after the copy """
+
+        files = {}
+        for root, dirs, names in os.walk(self.dirpath):
+            for name in names:
+                path = os.path.join(root, name)
+                relpath = os.path.relpath(path, self.dirpath)
+                if relpath.startswith(MANIFESTNAME):
+                    continue
+                entry = dict(self.files.get(relpath) or
+                             {'source': None, 'mtime': None, 'services': []})
+                if rehash or relpath not in self.files:
+                    DIGESTS.pop(path, None)
+                    entry['size'] = os.path.getsize(path)
+                    entry['sha256'] = file_digest(path)
+                files[relpath] = entry
+        self.files = files
+        self.write()
+
+    def write(self, dirpath=None):
+        """ Save the manifest into its directory """
+
+        dirpath = dirpath or self.dirpath
+        thisfile = os.path.join(dirpath, MANIFESTNAME)
+        tmpfile = thisfile + '.tmp'
+        f = open(tmpfile, 'w')
+        f.write(json.dumps({'files': self.files}, sort_keys=True, indent=2))
+        f.close()
+        os.rename(tmpfile, thisfile)
+
+
+class SyncedDir(object):
+    """ Rebuild an output directory beside it and swap it into place """
+
+    # Files whose source is unchanged since the previous run are hard
+    # linked from the current directory instead of being copied again.
+    # Files that are no longer collected are simply not carried over.
+    # The output directory is a symlink to the current tree, so a
+    # commit is a single rename of a new symlink over it.
+
+    def __init__(self, dest, inplace=False, requiredby=None):
+        self.dest = os.path.abspath(dest)
+        self.inplace = inplace
+        self.requiredby = requiredby or {}
+        self.previous = Manifest(self.dest)
+        self.manifest = Manifest(self.dest)
+        if not inplace:
+            self.manifest.files = {}
+        parent = os.path.dirname(self.dest)
+        if not os.path.isdir(parent):
+            os.makedirs(parent)
+        if inplace:
+            self.path = self.dest
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path)
+        else:
+            self.path = tempfile.mkdtemp(
+                prefix=".%s." % os.path.basename(self.dest), dir=parent)
+
+    def place(self, src, dst, link=True):
+        """ Copy src to dst, reusing the previous copy when unchanged """
+
+        relpath = os.path.relpath(dst, self.path)
+        found = None
+        if link:
+            found = self.previous.current(src)
+        if found:
+            old = os.path.join(self.dest, found[0])
+            if old != dst:
+                try:
+                    os.link(old, dst)
+                except OSError:
+                    shutil.copy2(old, dst)
+            entry = dict(found[1])
+        else:
+            placefile(src, dst, link)
+            st = os.stat(src)
+            entry = {'source': os.path.realpath(src),
+                     'size': st.st_size,
+                     'mtime': st.st_mtime,
+                     'sha256': DIGESTS.get(dst) or file_digest(dst)}
+        entry['services'] = sorted(self.requiredby.get(os.path.realpath(src), []))
+        DIGESTS[dst] = entry['sha256']
+        self.manifest.files[relpath] = entry
+
+    def commit(self):
+        """ Write the manifest and put the new directory in place """
+
+        self.manifest.files = dict(
+            [(k, v) for k, v in self.manifest.files.items()
+             if os.path.isfile(os.path.join(self.path, k))])
+        self.manifest.write(self.path)
+        if self.inplace:
+            return self.dest
+
+        # mkdtemp makes the tree 0700, give it the mode of the tree it
+        # replaces so other users can still read the jars
+        if os.path.isdir(self.dest):
+            mode = stat.S_IMODE(os.stat(self.dest).st_mode)
+        else:
+            umask = os.umask(0)
+            os.umask(umask)
+            mode = 0o777 & ~umask
+        os.chmod(self.path, mode)
+
+        # A symlink to the new tree is renamed over the dest symlink,
+        # which replaces it atomically, so readers see either the old
+        # or the new jars, never a partly copied or missing directory.
+        # A dest that is still a plain directory from an older version
+        # has to be moved aside first, that one time it briefly does
+        # not exist.
+        parent = os.path.dirname(self.dest)
+        old = None
+        if os.path.islink(self.dest):
+            old = os.path.join(parent, os.readlink(self.dest))
+        elif os.path.isdir(self.dest):
+            old = tempfile.mkdtemp(
+                prefix=".%s.old." % os.path.basename(self.dest), dir=parent)
+            os.rmdir(old)
+            os.rename(self.dest, old)
+        link = os.path.join(parent, ".%s.link.%s" % (os.path.basename(self.dest), os.getpid()))
+        if os.path.islink(link):
+            os.remove(link)
+        os.symlink(os.path.basename(self.path), link)
+        os.rename(link, self.dest)
+        if old and os.path.realpath(old) != os.path.realpath(self.path):
+            shutil.rmtree(old, ignore_errors=True)
+        LOG.debug("%s - %s files in place", self.dest, len(self.manifest.files))
+        self.path = self.dest
+        return self.dest
+
+
+def verify_manifest(dirpath, workers=COPYWORKERS):
+    """ Check a directory against its manifest, hashing in parallel """
+
+    manifest = Manifest(dirpath)
+    if not manifest.files:
+        LOG.error("verify - %s has no manifest", dirpath)
+        return 1
+
+    def check(item):
+        (relpath, entry) = item
+        path = os.path.join(dirpath, relpath)
+        if not os.path.isfile(path):
+            return (relpath, "missing")
+        size = os.path.getsize(path)
+        if size != entry.get('size'):
+            return (relpath, "size is %s, expected %s" % (size, entry.get('size')))
+        DIGESTS.pop(path, None)
+        if file_digest(path) != entry.get('sha256'):
+            return (relpath, "sha256 does not match")
+        return None
+
+    pool = ThreadPool(workers)
+    try:
+        problems = [x for x in pool.map(check, sorted(manifest.files.items())) if x]
+    finally:
+        pool.close()
+        pool.join()
+
+    for relpath, problem in problems:
+        LOG.error("verify - %s: %s", os.path.join(dirpath, relpath), problem)
+    for root, dirs, names in os.walk(dirpath):
+        for name in names:
+            relpath = os.path.relpath(os.path.join(root, name), dirpath)
+            if relpath not in manifest.files and not relpath.startswith(MANIFESTNAME):
+                LOG.warning("verify - %s is not in the manifest", os.path.join(dirpath, relpath))
+    LOG.info("verify - %s: %s files checked, %s problems",
+             dirpath, len(manifest.files), len(problems))
+    return len(problems)
+
+
+def bundle_entries(options):
+    """ The (arcname, path) pairs of a bundle, directories first, sorted """
+
+    entries = []
+    for arcroot, dirpath in [('jars', options.dir), ('conf', options.conf)]:
+        if not os.path.isdir(dirpath):
+            continue
+        entries.append((arcroot, dirpath))
+        for root, dirs, names in os.walk(dirpath):
+            dirs.sort()
+            for name in dirs + sorted(names):
+                path = os.path.join(root, name)
+                arcname = os.path.join(arcroot, os.path.relpath(path, dirpath))
+                entries.append((arcname, path))
+    return sorted(entries)
+
+
+def bundle_manifest(path):
+    """ The manifest of a bundled directory without its provenance """
+
+    # source paths and mtimes differ between hosts and runs, the archived
+    # copy keeps what identifies the files themselves
+    manifest = Manifest(os.path.dirname(path))
+    files = {}
+    for relpath, entry in manifest.files.items():
+        files[relpath] = {'sha256': entry.get('sha256')}
+        if relpath.endswith('.jar'):
+            files[relpath]['version'] = jar_version(
+                os.path.join(manifest.dirpath, relpath))
+    data = json.dumps({'files': files}, sort_keys=True, indent=2)
+    return data.encode('utf-8')
+
+
+def write_bundle(options):
+    ''' Write the jar and conf directories as a reproducible tarball '''
+
+    # Every header is normalized (sorted names, mtime 0, root owner,
+    # 0644/0755 modes, no hard links) so that the same files always give
+    # the same bytes, and container layers built from it stay cached.
+    # The manifests go in without their source paths and mtimes.
+    bundle = os.path.abspath(options.bundle)
+    if not os.path.isdir(os.path.dirname(bundle)):
+        os.makedirs(os.path.dirname(bundle))
+    tmpfile = bundle + '.tmp'
+    compress = bundle.endswith('.gz') or bundle.endswith('.tgz')
+
+    fout = open(tmpfile, 'wb')
+    p = None
+    out = fout
+    if compress:
+        pigz = getcmdpath('pigz')
+        if pigz:
+            # -n leaves the name and timestamp out of the gzip header
+            p = Popen([pigz, '-n', '-c'], stdin=PIPE, stdout=fout)
+            out = p.stdin
+        else:
+            out = gzip.GzipFile(filename='', mode='wb', fileobj=fout, mtime=0)
+
+    count = 0
+    tar = tarfile.open(fileobj=out, mode='w|', format=tarfile.GNU_FORMAT)
+    for arcname, path in bundle_entries(options):
+        st = os.stat(path)
+        ti = tarfile.TarInfo(arcname)
+        ti.mtime = 0
+        ti.uid = ti.gid = 0
+        ti.uname = ti.gname = 'root'
+        if stat.S_ISDIR(st.st_mode):
+            ti.type = tarfile.DIRTYPE
+            ti.mode = 0o755
+            tar.addfile(ti)
+            continue
+        ti.mode = 0o755 if st.st_mode & 0o111 else 0o644
+        if os.path.basename(path) == MANIFESTNAME:
+            data = bundle_manifest(path)
+            ti.size = len(data)
+            tar.addfile(ti, io.BytesIO(data))
+            count += 1
+            continue
+        ti.size = st.st_size
+        f = open(path, 'rb')
+        try:
+            tar.addfile(ti, f)
+        finally:
+            f.close()
+        count += 1
+    tar.close()
+
+    out.close()
+    if p:
+        p.wait()
+    if out is not fout:
+        fout.close()
+    if p and p.returncode != 0:
+        os.remove(tmpfile)
+        LOG.error("bundle - pigz failed with %s", p.returncode)
+        return False
+    os.rename(tmpfile, bundle)
+    LOG.info("bundle - wrote %s files to %s", count, bundle)
+    return True
+
+
+def placefile(src, dst, link=True):
+    """ Copy a file, reusing the copy the pipeline already made of it """
+
+    if COPYPIPELINE and COPYPIPELINE.place(src, dst, link):
+        return
+    shutil.copy(src, dst)
+
+
 def copyjars(options, datadict):
     ''' Copy JAR files to a designated place '''
 
     LOG.debug("Evaluating found jars ...")
     jarfiles = []
     sparkfiles = []
+    requiredby = {}
     dest = options.dir
     for k, v in datadict.items():
         if 'jarfiles' in v:
             if v['jarfiles']:
                 for jf in v['jarfiles']:
                     LOG.debug('%s requires %s', k, jf)
+                    requiredby.setdefault(os.path.realpath(jf), set()).add(k)
                     if jf not in jarfiles and '/sas.' not in jf:
 
                         finalpath = jf
@@ -4440,8 +6210,9 @@ def copyjars(options, datadict):
             sparkfiles = Tracer.filter_jars_by_inclasspath(
                 sparkfiles, filter=hive_jars)
         elif options.filterby == "hcat":
+            hcat = Tracer.get_cmd_paths().get('hcat') or 'hcat'
             (hcat_dirs, hcat_jars) = Tracer.run_and_parse_classpath(
-                cmd="hcat -classpath")
+                cmd="%s -classpath" % hcat)
             jarfiles = Tracer.filter_jars_by_inclasspath(
                 jarfiles, filter=hcat_jars)
             sparkfiles = Tracer.filter_jars_by_inclasspath(
@@ -4456,17 +6227,12 @@ def copyjars(options, datadict):
     assert not os.path.isfile(dest), \
         "%s is a file and jars cannot be copied here" % dest
 
-    if not os.path.isdir(dest) and not os.path.isfile(dest):
-        os.makedirs(dest)
+    jardir = SyncedDir(dest, inplace=options.nooverwrite, requiredby=requiredby)
+    dest = jardir.path
+    if not os.path.isdir(dest + "/spark"):
         os.makedirs(dest + "/spark")
-    else:
-        if not options.nooverwrite:
-            LOG.debug("emptying contents of %s", dest)
-            shutil.rmtree(dest)
-            os.makedirs(dest)
-            os.makedirs(dest + "/spark")
 
-    LOG.info("Copying jars to %s", dest)
+    LOG.info("Copying jars to %s", jardir.dest)
     # these are some exclusive JAR files that are with spark which have to be found via find.
     sparkjarfiles = ["scala-compiler-2*", "scalap-2*", "scala-parser-combinators_2*", "spark-streaming_2*", "spark-repl*", "spark-mllib-local_*", "spark-graphx_2*", "spark-graphx_2*", "spark-sketch*", "spark-sketch*", "spark-streaming-flume_2*", "spark-streaming-flume-sink_2*", "spark-yarn_2*", "spark-avro_2*", "spark-lineage_2*", "spark-streaming-kafka*", "spark-hadoop-cloud*"]
     if os.path.isdir("/opt/cloudera/parcels"):
@@ -4600,15 +6366,15 @@ def copyjars(options, datadict):
                 if 'hive-warehouse-connector-assembly' in jf:
                     os.makedirs(dest + "/hive_warehouse_connector")
                     thish = os.path.join(dest + "/hive_warehouse_connector/", thisf)
-                    LOG.info("copy %s to %s", jf, os.path.join(dest + "/hive_warehouse_connector/"))
+                    LOG.info("copy %s to %s", jf, os.path.join(jardir.dest + "/hive_warehouse_connector/"))
                     try:
-                        shutil.copy(jf, thish)
+                        jardir.place(jf, thish)
                     except Exception as e:
                         LOG.error("%s", e)
                 else:
-                    LOG.info("copy %s to %s", jf, dest)
+                    LOG.info("copy %s to %s", jf, jardir.dest)
                     # continue
-                    shutil.copy(jf, thisp)
+                    jardir.place(jf, thisp)
             except Exception as e:
                 LOG.error("%s", e)
 
@@ -4616,36 +6382,37 @@ def copyjars(options, datadict):
         thisf = os.path.basename(sf)
         thisp = os.path.join(dest + "/spark/", thisf)
         if not os.path.isfile(thisp) and os.path.isfile(sf):
-            LOG.info("copy %s to %s", sf, dest + "/spark")
+            LOG.info("copy %s to %s", sf, jardir.dest + "/spark")
             try:
-                shutil.copy(sf, thisp)
+                jardir.place(sf, thisp)
             except Exception as e:
                 LOG.error("%s", e)
 
+    return jardir
 
-def dedupejars(options):
-    ''' Remove duplicate jar files s by md5sum result '''
 
-    md5cmd = getcmdpath('md5sum')
-    cmd = "%s *.jar" % md5cmd
+def dedupejars(options, jardir=None):
+    ''' Remove duplicate jar files by checksum '''
+
     jardict = {}
     sparkjardict = {}
-    (rc, so, se) = run_command(cmd, checkrc=False, cwd=options.dir)
+    jardir = jardir or options.dir
 
-    if rc != 0:
+    if not os.path.isdir(jardir):
         return False
 
-    lines = so.split('\n')
-    lines = [x for x in lines if x and x.endswith('.jar')]
-    for line in lines:
-        parts = shlex.split(line)
-        md5 = parts[0]
-        jar = parts[1]
-        if md5 not in jardict:
-            jardict[md5] = []
-            sparkjardict[md5] = []
-        jardict[md5].append(jar)
-        sparkjardict[md5].append(jar)
+    # the copy pipeline already knows the digests of the files it placed
+    for jar in sorted(os.listdir(jardir)):
+        if not jar.endswith('.jar'):
+            continue
+        digest = file_digest(os.path.join(jardir, jar))
+        if digest is None:
+            continue
+        if digest not in jardict:
+            jardict[digest] = []
+            sparkjardict[digest] = []
+        jardict[digest].append(jar)
+        sparkjardict[digest].append(jar)
 
     for k, v in jardict.items():
         if len(v) == 1:
@@ -4654,56 +6421,56 @@ def dedupejars(options):
         # keep the longest filename
         longest = v[0]
         for jf in v:
-            if len(jf) > longest:
+            if len(jf) > len(longest):
                 longest = jf
         for jf in v:
             if jf != longest:
-                delpath = os.path.join(options.dir, jf)
+                delpath = os.path.join(jardir, jf)
                 LOG.debug('%s duplicates %s, removed', jf, longest)
                 os.remove(delpath)
 
-    cmd = "%s *.jar" % md5cmd
-    (rc, so, se) = run_command(cmd, checkrc=False, cwd=options.dir + "/spark")
-
-    lines = so.split('\n')
-    lines = [x for x in lines if x and x.endswith('.jar')]
-    for line in lines:
-        parts = shlex.split(line)
-        md5 = parts[0]
-        jar = parts[1]
-        if md5 not in sparkjardict:
-            sparkjardict[md5] = []
-        sparkjardict[md5].append(jar)
+    sparkdir = jardir + "/spark"
+    if not os.path.isdir(sparkdir):
+        return True
+    for jar in sorted(os.listdir(sparkdir)):
+        if not jar.endswith('.jar'):
+            continue
+        digest = file_digest(os.path.join(sparkdir, jar))
+        if digest is None:
+            continue
+        if digest not in sparkjardict:
+            sparkjardict[digest] = []
+        sparkjardict[digest].append(jar)
     for k, v in sparkjardict.items():
         if len(v) == 1:
             continue
-        delpath = os.path.join(options.dir + "/spark/", v[0])
-        LOG.debug('%s duplicates removed from spark folder', v[0])
-        os.remove(delpath)
+        delpath = os.path.join(jardir + "/spark/", v[0])
+        if os.path.isfile(delpath):
+            LOG.debug('%s duplicates removed from spark folder', v[0])
+            os.remove(delpath)
+    return True
 
 
 def copyconfig(options, datadict):
     """ Copy sitex,l files """
 
     confiles = []
+    requiredby = {}
     dest = options.conf
     for k, v in datadict.items():
         if 'sitexmls' in v:
             if v['sitexmls']:
                 for sx in v['sitexmls']:
+                    requiredby.setdefault(os.path.realpath(sx), set()).add(k)
                     if sx not in confiles:
                         confiles.append(sx)
 
     assert not os.path.isfile(dest), \
         "%s is a file and site xmls cannot be copied here" % dest
 
-    if not os.path.isdir(dest) and not os.path.isfile(dest):
-        os.makedirs(dest)
-    else:
-        if not options.nooverwrite:
-            LOG.debug("emptying contents of %s", dest)
-            shutil.rmtree(dest)
-            os.makedirs(dest)
+    confdir = SyncedDir(dest, inplace=options.nooverwrite,
+                        requiredby=requiredby)
+    dest = confdir.path
 
     # (rc, so, se) = run_command("hadoop fs -ls /sas/ep/config/dmp-config.xml")
     # if rc == 0:
@@ -4745,12 +6512,583 @@ def copyconfig(options, datadict):
         thisf = os.path.basename(sx)
         thisp = os.path.join(dest, thisf)
         if not os.path.isfile(thisp):
-            LOG.info("copy %s to %s", sx, dest)
+            LOG.info("copy %s to %s", sx, confdir.dest)
             try:
-                shutil.copy(sx, thisp)
+                # post processing edits these in place, so always copy
+                confdir.place(sx, thisp, link=False)
             except Exception as e:
                 LOG.debug("%s", e)
 
+    return confdir
+
+
+def write_manifest_jar(jarpath, entries):
+    ''' Write a jar whose manifest Class-Path references the entries '''
+
+    # The manifest Class-Path takes space separated relative URLs and
+    # does not understand classpath wildcards, so directories need a
+    # trailing slash and globs have to be expanded by the caller.
+    urls = []
+    for x in entries:
+        if not x.endswith('/') and os.path.isdir(x):
+            x += '/'
+        urls.append(urlquote(x))
+
+    # manifest lines are limited to 72 bytes, continuations start with a space
+    header = 'Class-Path: ' + ' '.join(urls)
+    lines = [header[:72]]
+    header = header[72:]
+    while header:
+        lines.append(' ' + header[:71])
+        header = header[71:]
+
+    manifest = 'Manifest-Version: 1.0\r\n'
+    manifest += 'Created-By: hadooptracer\r\n'
+    manifest += '\r\n'.join(lines) + '\r\n\r\n'
+
+    # use a fixed timestamp so unchanged classpaths produce identical jars
+    zinfo = zipfile.ZipInfo('META-INF/MANIFEST.MF', date_time=(1980, 1, 1, 0, 0, 0))
+    zinfo.compress_type = zipfile.ZIP_DEFLATED
+    zf = zipfile.ZipFile(jarpath, 'w')
+    zf.writestr(zinfo, manifest)
+    zf.close()
+    return jarpath
+
+
+def rank_jars_by_classloads(datadict):
+    ''' Order the loaded jars by load count and first load position '''
+
+    # fqns are (class, jar) tuples in load order, so the index of the
+    # first class loaded from a jar stands in for its first load time.
+    counts = {}
+    firstload = {}
+    for k, v in datadict.items():
+        if not isinstance(v, dict) or not v.get('fqns'):
+            continue
+        for idx, (fqn, jar) in enumerate(v['fqns']):
+            counts[jar] = counts.get(jar, 0) + 1
+            if jar not in firstload or idx < firstload[jar]:
+                firstload[jar] = idx
+
+    ranked = sorted(counts.keys(), key=lambda x: (-counts[x], firstload[x], x))
+    return [(x, counts[x], firstload[x]) for x in ranked]
+
+
+def write_ordered_classpath(options, datadict):
+    ''' Write the collected jars as a hot-first classpath '''
+
+    ranked = rank_jars_by_classloads(datadict)
+    for jar, count, first in ranked[:10]:
+        LOG.debug("classpath order - %s classes loaded from %s (first at %s)", count, jar, first)
+
+    # Translate the traced jar paths to their copies in the jar dir and
+    # append whatever was copied without being seen in a class load.
+    dest = os.path.abspath(options.dir)
+    copied = sorted(os.path.basename(x) for x in glob.glob(os.path.join(dest, '*.jar')))
+    if options.classpathjar:
+        copied = [x for x in copied if x != os.path.basename(options.classpathjar)]
+    copiedset = set(copied)
+    ordered = []
+    orderedset = set()
+    for jar, count, first in ranked:
+        bn = os.path.basename(jar)
+        if bn in copiedset and bn not in orderedset:
+            orderedset.add(bn)
+            ordered.append(bn)
+    ordered += [x for x in copied if x not in orderedset]
+
+    if options.classpathfile:
+        f = open(options.classpathfile, 'w')
+        f.write(':'.join(os.path.join(dest, x) for x in ordered) + '\n')
+        f.close()
+        LOG.info("classpath with %s jars written to %s", len(ordered), options.classpathfile)
+
+    if options.classpathjar:
+        # entries relative to the jar dir keep the jar relocatable
+        entries = ordered
+        if os.path.dirname(os.path.abspath(options.classpathjar)) != dest:
+            entries = [os.path.join(dest, x) for x in ordered]
+        write_manifest_jar(options.classpathjar, entries)
+        LOG.info("classpath jar written to %s", options.classpathjar)
+
+    return ordered
+
+
+def service_family(svckey):
+    """ Map a service key to the family of JVMs that share its classes """
+
+    if svckey in SERVICEFAMILIES:
+        return SERVICEFAMILIES[svckey]
+    return svckey.split('-')[0]
+
+
+def write_appcds(options, datadict):
+    ''' Write AppCDS class lists and archives for the collected jars '''
+
+    # The -verbose:class output of each service is the exact list of
+    # classes its JVM loaded, which is what -XX:SharedClassListFile
+    # expects. Merge the lists per service family, keeping the order
+    # in which the classes were first loaded.
+    dest = options.appcds
+    if not os.path.isdir(dest):
+        os.makedirs(dest)
+
+    classlists = {}
+    for k in sorted(datadict.keys()):
+        v = datadict[k]
+        if not isinstance(v, dict) or not v.get('fqns'):
+            continue
+        family = service_family(k)
+        if family not in classlists:
+            classlists[family] = ([], set())
+        (names, seen) = classlists[family]
+        for fqn, jar in v['fqns']:
+            name = fqn.replace('.', '/')
+            if name not in seen:
+                seen.add(name)
+                names.append(name)
+
+    if not classlists:
+        LOG.info("appcds - no class loading data was collected")
+        return False
+
+    # The archive is only valid for the classpath it was dumped with,
+    # so it is built against the collected jar directory and that
+    # classpath is written out for the consumers to use verbatim.
+    jars = sorted(glob.glob(os.path.join(options.dir, '*.jar')))
+    classpath = ':'.join(jars)
+    (jdk, jre, jarcmd) = Tracer.get_jdk_jre_jar_commands()
+    if not jre:
+        LOG.info("appcds - no java command was found, skipping the archive dump")
+    else:
+        # JDK 8 only archives app classes with the commercial
+        # -XX:+UseAppCDS, OpenJDK has AppCDS from 10 on
+        version = java_major_version(jre)
+        if not version or version < 10:
+            LOG.info("appcds - %s is java %s, AppCDS needs java 10 or later, "
+                     "skipping the archive dump", jre, version)
+            jre = None
+
+    for family in sorted(classlists.keys()):
+        names = classlists[family][0]
+        listfile = os.path.join(dest, '%s.classlist' % family)
+        f = open(listfile, 'w')
+        for name in names:
+            f.write(name + '\n')
+        f.close()
+        LOG.info("appcds - %s classes written to %s", len(names), listfile)
+
+        if not jre:
+            continue
+
+        cpfile = os.path.join(dest, '%s.classpath' % family)
+        f = open(cpfile, 'w')
+        f.write(classpath + '\n')
+        f.close()
+
+        # hundreds of jars overflow the per argument limit of execve, so
+        # the classpath goes in a java @argfile
+        argfile = os.path.join(dest, '%s.args' % family)
+        f = open(argfile, 'w')
+        f.write('-cp "%s"\n' % classpath.replace('\\', '\\\\').replace('"', '\\"'))
+        f.close()
+
+        archive = os.path.join(dest, '%s.jsa' % family)
+        cmd = "%s -Xshare:dump -XX:SharedClassListFile=%s" % (jre, listfile)
+        cmd += " -XX:SharedArchiveFile=%s @%s" % (archive, argfile)
+        (rc, so, se) = run_command(cmd, checkrc=False)
+        if rc == 0 and os.path.isfile(archive):
+            LOG.info("appcds - archive for %s written to %s", family, archive)
+        else:
+            LOG.warning("appcds - dumping the %s archive failed (rc: %s)", family, rc)
+            for line in [x for x in (str(so) + str(se)).split('\n') if 'Error' in x]:
+                LOG.debug("appcds - %s", line.strip())
+
+    return True
+
+
+############################################################
+#   PUBLISHING
+############################################################
+
+class ObjectStore(object):
+    """ Minimal object store client for publishing the collected files """
+
+    # Each store sets ENDPOINT, formatted with its attributes, for when
+    # no endpoint such as a local emulator is given. Files larger than
+    # PUBLISHCHUNK are sent in at most MAXPARTS parts, several at once:
+    # begin() starts the upload, putpart() sends one part, finish()
+    # assembles them and abort() drops them after a failure.
+
+    MAXPARTS = 10000
+
+    def __init__(self, url, endpoint=None):
+        parts = urlsplit(url)
+        self.location = parts.netloc
+        self.prefix = parts.path.strip('/')
+        self.endpoint = (endpoint or self.ENDPOINT % self.__dict__).rstrip('/')
+        ep = urlsplit(self.endpoint)
+        self.secure = ep.scheme == 'https'
+        self.host = ep.netloc
+        self.basepath = ep.path.rstrip('/')
+        self.partpool = None
+        self.lock = threading.Lock()
+
+    def key(self, name):
+        """ The object name of a published file """
+        return '/'.join([x for x in [self.prefix, name] if x])
+
+    def authorize(self, method, path, query, headers, body):
+        """ Add credentials to a request """
+        return (query, headers)
+
+    def request(self, method, path, query=None, headers=None, body=b''):
+        """ Send one request, retrying connection errors and 5xx replies """
+
+        error = None
+        for attempt in range(PUBLISHRETRIES):
+            if attempt:
+                time.sleep(2 ** attempt)
+            (thisquery, thisheaders) = self.authorize(
+                method, path, list(query or []), dict(headers or {}), body)
+            qs = '&'.join(['%s=%s' % (urlquote(k, safe='-_.~'), urlquote(v, safe='-_.~'))
+                           for k, v in sorted(thisquery)])
+            if self.secure:
+                conn = HTTPSConnection(self.host, timeout=300)
+            else:
+                conn = HTTPConnection(self.host, timeout=300)
+            try:
+                conn.request(method, path + ('?' + qs if qs else ''), body, thisheaders)
+                resp = conn.getresponse()
+                data = resp.read()
+                rheaders = dict([(k.lower(), v) for k, v in resp.getheaders()])
+            except (socket.error, HTTPException) as e:
+                error = "%s %s: %s" % (method, path, e)
+                continue
+            finally:
+                conn.close()
+            if resp.status < 500:
+                return (resp.status, rheaders, data)
+            error = "%s %s: HTTP %s" % (method, path, resp.status)
+        raise IOError(error)
+
+    def expect(self, reply, statuses, what):
+        """ Raise unless a reply has one of the expected statuses """
+        if reply[0] not in statuses:
+            raise IOError("%s failed with HTTP %s: %s" % (what, reply[0], reply[2][:500]))
+        return reply
+
+    def parts(self):
+        """ The pool the parts of all files are uploaded on """
+
+        # Separate from the pool of files, whose workers wait for the
+        # parts, so the two can never starve each other.
+        with self.lock:
+            if self.partpool is None:
+                self.partpool = ThreadPool(PUBLISHWORKERS)
+        return self.partpool
+
+    def upload(self, key, path, sha256):
+        """ Upload a file in one request or in parallel parts """
+
+        size = os.path.getsize(path)
+        if size <= PUBLISHCHUNK:
+            self.put(key, read_range(path, 0, size), sha256)
+            return
+
+        partsize = max(PUBLISHCHUNK, -(-size // self.MAXPARTS))
+        parts = [(number + 1, offset, min(partsize, size - offset))
+                 for number, offset in enumerate(range(0, size, partsize))]
+        state = self.begin(key, sha256, len(parts))
+        try:
+            results = self.parts().map(
+                lambda part: self.putpart(key, state, part[0],
+                                          read_range(path, part[1], part[2])),
+                parts)
+            self.finish(key, state, results, sha256)
+        except (IOError, OSError, ValueError, KeyError, IndexError):
+            self.abort(key, state, len(parts))
+            raise
+
+    def close(self):
+        """ Stop the part workers """
+
+        if self.partpool is not None:
+            self.partpool.close()
+            self.partpool.join()
+            self.partpool = None
+
+
+def read_range(path, offset, length):
+    """ Read length bytes of a file from offset """
+
+    f = open(path, 'rb')
+    try:
+        f.seek(offset)
+        return f.read(length)
+    finally:
+        f.close()
+
+
+class S3Store(ObjectStore):
+    """ s3://bucket/prefix, signed with AWS signature version 4 """
+
+    ENDPOINT = 'https://s3.%(region)s.amazonaws.com'
+
+    def __init__(self, url, endpoint=None):
+        self.region = os.environ.get('AWS_REGION') or \
+            os.environ.get('AWS_DEFAULT_REGION') or 'us-east-1'
+        ObjectStore.__init__(self, url, endpoint)
+        self.accesskey = os.environ.get('AWS_ACCESS_KEY_ID', '')
+        self.secretkey = os.environ.get('AWS_SECRET_ACCESS_KEY', '')
+        self.token = os.environ.get('AWS_SESSION_TOKEN')
+
+    def objpath(self, key):
+        return '%s/%s/%s' % (self.basepath, self.location, urlquote(key, safe='/-_.~'))
+
+    def authorize(self, method, path, query, headers, body):
+        amzdate = time.strftime('%Y%m%dT%H%M%SZ', time.gmtime())
+        headers['host'] = self.host
+        headers['x-amz-date'] = amzdate
+        headers['x-amz-content-sha256'] = hashlib.sha256(body).hexdigest()
+        if self.token:
+            headers['x-amz-security-token'] = self.token
+        signed = sorted(headers.keys())
+        canonical = '\n'.join([
+            method, path,
+            '&'.join(['%s=%s' % (urlquote(k, safe='-_.~'), urlquote(v, safe='-_.~'))
+                      for k, v in sorted(query)]),
+            ''.join(['%s:%s\n' % (k, str(headers[k]).strip()) for k in signed]),
+            ';'.join(signed),
+            headers['x-amz-content-sha256']])
+        scope = '%s/%s/s3/aws4_request' % (amzdate[:8], self.region)
+        tosign = '\n'.join(['AWS4-HMAC-SHA256', amzdate, scope,
+                            hashlib.sha256(canonical.encode('utf-8')).hexdigest()])
+        key = ('AWS4' + self.secretkey).encode('utf-8')
+        for x in [amzdate[:8], self.region, 's3', 'aws4_request']:
+            key = hmac.new(key, x.encode('utf-8'), hashlib.sha256).digest()
+        signature = hmac.new(key, tosign.encode('utf-8'), hashlib.sha256).hexdigest()
+        headers['authorization'] = \
+            'AWS4-HMAC-SHA256 Credential=%s/%s, SignedHeaders=%s, Signature=%s' % \
+            (self.accesskey, scope, ';'.join(signed), signature)
+        return (query, headers)
+
+    def matches(self, key, sha256):
+        reply = self.request('HEAD', self.objpath(key))
+        return reply[0] == 200 and reply[1].get('x-amz-meta-sha256') == sha256
+
+    def put(self, key, data, sha256):
+        self.expect(self.request('PUT', self.objpath(key),
+                                 headers={'x-amz-meta-sha256': sha256}, body=data),
+                    [200], "upload of %s" % key)
+
+    def begin(self, key, sha256, count):
+        reply = self.expect(self.request('POST', self.objpath(key), [('uploads', '')],
+                                         {'x-amz-meta-sha256': sha256}),
+                            [200], "multipart start of %s" % key)
+        return [x.text for x in ET.fromstring(reply[2]).iter()
+                if x.tag.endswith('UploadId')][0]
+
+    def putpart(self, key, uploadid, number, data):
+        reply = self.expect(self.request(
+            'PUT', self.objpath(key),
+            [('partNumber', str(number)), ('uploadId', uploadid)], body=data),
+            [200], "part %s of %s" % (number, key))
+        return '<Part><PartNumber>%s</PartNumber><ETag>%s</ETag></Part>' % \
+            (number, reply[1].get('etag'))
+
+    def finish(self, key, uploadid, results, sha256):
+        body = '<CompleteMultipartUpload>%s</CompleteMultipartUpload>' % ''.join(results)
+        self.expect(self.request('POST', self.objpath(key), [('uploadId', uploadid)],
+                                 body=body.encode('utf-8')),
+                    [200], "multipart completion of %s" % key)
+
+    def abort(self, key, uploadid, count):
+        self.request('DELETE', self.objpath(key), [('uploadId', uploadid)])
+
+
+class AzureBlobStore(ObjectStore):
+    """ azure://account/container/prefix, for blob storage and ADLS Gen2 """
+
+    ENDPOINT = 'https://%(account)s.blob.core.windows.net'
+    MAXPARTS = 50000
+
+    def __init__(self, url, endpoint=None):
+        self.account = urlsplit(url).netloc
+        ObjectStore.__init__(self, url, endpoint)
+        (self.location, self.prefix) = (self.prefix.split('/', 1) + [''])[:2]
+        self.sas = parse_qsl(os.environ.get('AZURE_STORAGE_SAS_TOKEN', '').lstrip('?'))
+
+    def objpath(self, key):
+        return '%s/%s/%s' % (self.basepath, self.location, urlquote(key, safe='/-_.~'))
+
+    def authorize(self, method, path, query, headers, body):
+        headers['x-ms-version'] = '2020-04-08'
+        headers['x-ms-date'] = time.strftime('%a, %d %b %Y %H:%M:%S GMT', time.gmtime())
+        return (query + self.sas, headers)
+
+    def matches(self, key, sha256):
+        reply = self.request('HEAD', self.objpath(key))
+        return reply[0] == 200 and reply[1].get('x-ms-meta-sha256') == sha256
+
+    def put(self, key, data, sha256):
+        self.expect(self.request('PUT', self.objpath(key),
+                                 headers={'x-ms-meta-sha256': sha256,
+                                          'x-ms-blob-type': 'BlockBlob'},
+                                 body=data),
+                    [201], "upload of %s" % key)
+
+    def begin(self, key, sha256, count):
+        return None
+
+    def putpart(self, key, state, number, data):
+        blockid = base64.b64encode(('%08d' % number).encode('utf-8')).decode('utf-8')
+        self.expect(self.request('PUT', self.objpath(key),
+                                 [('comp', 'block'), ('blockid', blockid)], body=data),
+                    [201], "block %s of %s" % (number, key))
+        return '<Latest>%s</Latest>' % blockid
+
+    def finish(self, key, state, results, sha256):
+        body = '<?xml version="1.0" encoding="utf-8"?><BlockList>%s</BlockList>' % ''.join(results)
+        self.expect(self.request('PUT', self.objpath(key), [('comp', 'blocklist')],
+                                 {'x-ms-meta-sha256': sha256}, body.encode('utf-8')),
+                    [201], "block list of %s" % key)
+
+    def abort(self, key, state, count):
+        # uncommitted blocks are dropped by the service after a week
+        pass
+
+
+class GCSStore(ObjectStore):
+    """ gs://bucket/prefix, through the JSON API """
+
+    # Parts are uploaded as temporary objects and composed into the
+    # final one, which takes at most 32 sources.
+
+    ENDPOINT = 'https://storage.googleapis.com'
+    MAXPARTS = 32
+
+    def __init__(self, url, endpoint=None):
+        ObjectStore.__init__(self, url, endpoint)
+        self.token = os.environ.get('GOOGLE_OAUTH_ACCESS_TOKEN')
+
+    def objpath(self, key):
+        return '%s/storage/v1/b/%s/o/%s' % (self.basepath, self.location, urlquote(key, safe=''))
+
+    def authorize(self, method, path, query, headers, body):
+        if self.token:
+            headers['authorization'] = 'Bearer %s' % self.token
+        return (query, headers)
+
+    def matches(self, key, sha256):
+        reply = self.request('GET', self.objpath(key))
+        if reply[0] != 200:
+            return False
+        metadata = json.loads(reply[2].decode('utf-8')).get('metadata') or {}
+        return metadata.get('sha256') == sha256
+
+    def put(self, key, data, sha256):
+        # the metadata and the data go in one multipart/related request
+        boundary = 'hadooptracer-%s' % sha256[:24]
+        meta = json.dumps({'name': key, 'metadata': {'sha256': sha256}})
+        body = ('--%s\r\ncontent-type: application/json; charset=UTF-8\r\n\r\n%s\r\n'
+                '--%s\r\ncontent-type: application/octet-stream\r\n\r\n' %
+                (boundary, meta, boundary)).encode('utf-8') + \
+            data + ('\r\n--%s--\r\n' % boundary).encode('utf-8')
+        self.expect(self.request(
+            'POST', '%s/upload/storage/v1/b/%s/o' % (self.basepath, self.location),
+            [('uploadType', 'multipart')],
+            {'content-type': 'multipart/related; boundary=%s' % boundary}, body),
+            [200], "upload of %s" % key)
+
+    def partname(self, key, sha256, number):
+        return '%s.hadooptracer-part.%s.%05d' % (key, sha256[:16], number)
+
+    def begin(self, key, sha256, count):
+        return sha256
+
+    def putpart(self, key, state, number, data):
+        name = self.partname(key, state, number)
+        self.expect(self.request(
+            'POST', '%s/upload/storage/v1/b/%s/o' % (self.basepath, self.location),
+            [('uploadType', 'media'), ('name', name)],
+            {'content-type': 'application/octet-stream'}, data),
+            [200], "part %s of %s" % (number, key))
+        return name
+
+    def finish(self, key, state, results, sha256):
+        body = json.dumps({'sourceObjects': [{'name': x} for x in results],
+                           'destination': {'contentType': 'application/octet-stream',
+                                           'metadata': {'sha256': sha256}}})
+        self.expect(self.request('POST', self.objpath(key) + '/compose',
+                                 headers={'content-type': 'application/json'},
+                                 body=body.encode('utf-8')),
+                    [200], "compose of %s" % key)
+        self.abort(key, state, len(results))
+
+    def abort(self, key, state, count):
+        self.parts().map(
+            lambda number: self.request('DELETE', self.objpath(self.partname(key, state, number))),
+            range(1, count + 1))
+
+
+OBJECTSTORES = {'s3': S3Store, 'azure': AzureBlobStore, 'gs': GCSStore}
+
+
+def publish(options):
+    ''' Upload the manifest-listed jars and site xmls to an object store '''
+
+    scheme = urlsplit(options.publish).scheme
+    if scheme not in OBJECTSTORES:
+        LOG.error("publish - unsupported location %s, use one of %s",
+                  options.publish, ', '.join(['%s://' % x for x in sorted(OBJECTSTORES)]))
+        return 1
+    store = OBJECTSTORES[scheme](options.publish, options.publishendpoint)
+
+    files = []
+    manifests = []
+    for arcroot, dirpath in [('jars', options.dir), ('conf', options.conf)]:
+        manifest = Manifest(dirpath)
+        for relpath, entry in sorted(manifest.files.items()):
+            files.append((store.key('%s/%s' % (arcroot, relpath)),
+                          os.path.join(dirpath, relpath), entry['sha256']))
+        thisfile = os.path.join(dirpath, MANIFESTNAME)
+        if os.path.isfile(thisfile):
+            manifests.append((store.key('%s/%s' % (arcroot, MANIFESTNAME)),
+                              thisfile, file_digest(thisfile)))
+    if options.bundle and os.path.isfile(options.bundle):
+        files.append((store.key(os.path.basename(options.bundle)),
+                      options.bundle, file_digest(options.bundle)))
+
+    def push(item):
+        (key, path, sha256) = item
+        try:
+            if store.matches(key, sha256):
+                return 'unchanged'
+            store.upload(key, path, sha256)
+            LOG.debug("publish - uploaded %s", key)
+            return 'uploaded'
+        except (IOError, OSError, ValueError, KeyError, IndexError) as e:
+            LOG.error("publish - %s: %s", key, e)
+            return 'failed'
+
+    # The manifests go last, so a reader that finds them finds every
+    # file they list.
+    pool = ThreadPool(PUBLISHWORKERS)
+    try:
+        results = pool.map(push, files)
+        if 'failed' not in results:
+            results += [push(x) for x in manifests]
+    finally:
+        pool.close()
+        pool.join()
+        store.close()
+
+    LOG.info("publish - %s: %s uploaded, %s unchanged, %s failed",
+             options.publish, results.count('uploaded'),
+             results.count('unchanged'), results.count('failed'))
+    return results.count('failed')
+
 
 ############################################################
 #   EXECUTION MODIFIERS
@@ -4785,6 +7123,93 @@ def converge_services():
                 SERVICES[k]['data'] = None
 
 
+class PrefetchContext(object):
+    """ Discovery results computed once and shared by every tracer """
+
+    def __init__(self):
+        self.results = {}
+        self.timings = {}
+        self.lock = threading.Lock()
+        self.keylocks = {}
+
+    def get(self, key, func, *args):
+        """ Run func once for key; callers get their own copy """
+
+        with self.lock:
+            if key not in self.keylocks:
+                self.keylocks[key] = threading.Lock()
+            keylock = self.keylocks[key]
+        with keylock:
+            if key not in self.results:
+                start = time.time()
+                self.results[key] = func(*args)
+                self.timings[key] = time.time() - start
+        return copy.deepcopy(self.results[key])
+
+    def run(self, jobs):
+        """ Run (key, func, args) discovery jobs concurrently """
+
+        def runjob(job):
+            # a failure is left for the tracer that needs it to report
+            try:
+                self.get(job[0], job[1], *job[2])
+            except Exception as e:
+                LOG.warning("prefetch - %s failed: %s", job[0], e)
+
+        pool = ThreadPool(len(jobs))
+        try:
+            pool.map(runjob, jobs)
+        finally:
+            pool.close()
+            pool.join()
+
+
+def prefetchcontext():
+    """ The discovery results shared by all tracers """
+
+    global PREFETCH
+    if PREFETCH is None:
+        PREFETCH = PrefetchContext()
+    return PREFETCH
+
+
+def prefetch(options):
+    ''' Run the discovery commands the tracers need, all at once '''
+
+    # The tracers are forked from this process, so anything found here
+    # is inherited by all of them instead of being looked up by each.
+    # SERVICES only holds the services that are still to be traced.
+    wanted = list(SERVICES.keys())
+    families = set([service_family(x) for x in wanted])
+
+    context = prefetchcontext()
+    cmdpaths = Tracer.get_cmd_paths()
+
+    jobs = [('hadoop classpath', listhadoopclasspath, ()),
+            ('jdkbasedir', findjdkbasedir, ()),
+            ('jdk', locatejdk, ())]
+    if not options.command:
+        mapred = getcmdpath('mapred')
+        if mapred and ('mapreduce' in wanted or 'spark' in wanted):
+            cmd = "%s classpath" % mapred
+            jobs.append((cmd, Tracer.parse_classpath_command, (cmd,)))
+        if cmdpaths.get('hcat') and \
+                ('hive' in families or options.filterby == 'hcat'):
+            cmd = "%s -classpath" % cmdpaths['hcat']
+            jobs.append((cmd, Tracer.parse_classpath_command, (cmd,)))
+        if cmdpaths.get('hive') and \
+                ('hive' in families or options.filterby == 'hive'):
+            jobs.append((('hiveinfo', WORKDIR), readhiveinfo, (WORKDIR, True)))
+
+    start = time.time()
+    context.run(jobs)
+    for key in sorted(context.timings, key=str):
+        LOG.debug("prefetch - %s: %.2fs", key, context.timings[key])
+    LOG.info("prefetch - %s discovery jobs finished in %.2fs",
+             len(context.timings), time.time() - start)
+    return context
+
+
 def add_hadoop_mr1_filter(filterlist):
     '''
     [root@jt-cdh526-0 ~]# hadoop version
@@ -4812,7 +7237,7 @@ def add_hadoop_mr1_filter(filterlist):
     From source with checksum aaad529f1796e0dea1f38178d4f6e2
     '''
 
-    hadoop_version = getversion("hadoop", [])
+    hadoop_version = getversion("hadoop", hadoopclasspathcmd())
     if hadoop_version:
 
         if '.' in hadoop_version:
@@ -4862,6 +7287,79 @@ def toggle_hivejdbc_or_beeline():
 #   Workflow functions
 ############################################################
 
+def checkpoint_path(checkpointdir, svckey):
+    """ The checkpoint file of a service """
+    return os.path.join(checkpointdir, urlquote(svckey, safe='') + CHECKPOINTSUFFIX)
+
+
+def write_checkpoint(checkpointdir, svckey, rdict):
+    """ Atomically save the results of a finished service """
+
+    if not checkpointdir:
+        return
+    try:
+        if not os.path.isdir(checkpointdir):
+            os.makedirs(checkpointdir)
+        thisfile = checkpoint_path(checkpointdir, svckey)
+        tmpfile = "%s.%s.tmp" % (thisfile, os.getpid())
+        f = open(tmpfile, "w")
+        f.write(json.dumps({'svckey': svckey, 'rdict': rdict}, sort_keys=True))
+        f.flush()
+        os.fsync(f.fileno())
+        f.close()
+        os.rename(tmpfile, thisfile)
+    except (IOError, OSError, TypeError, ValueError) as e:
+        LOG.error("%s - unable to write the checkpoint: %s", svckey, e)
+
+
+def load_checkpoints(checkpointdir):
+    """ Read the saved results of the services of a previous run """
+
+    datadict = {}
+    for thisfile in sorted(glob.glob(os.path.join(checkpointdir, '*' + CHECKPOINTSUFFIX))):
+        try:
+            f = open(thisfile)
+            data = json.load(f)
+            f.close()
+            datadict[data['svckey']] = data['rdict']
+        except (IOError, OSError, ValueError, KeyError) as e:
+            LOG.error("unable to read the checkpoint %s: %s", thisfile, e)
+    return datadict
+
+
+def load_results(thisfile):
+    """ Read the services of a hadooptracer.json results file """
+
+    f = open(thisfile)
+    datadict = json.load(f)
+    f.close()
+    datadict.pop('tracer_metadata', None)
+    return datadict
+
+
+def clear_checkpoints(checkpointdir):
+    """ Remove the saved results of a previous run """
+
+    for thisfile in glob.glob(os.path.join(checkpointdir, '*' + CHECKPOINTSUFFIX)):
+        os.remove(thisfile)
+    if os.path.isdir(checkpointdir) and not os.listdir(checkpointdir):
+        os.rmdir(checkpointdir)
+
+
+def failed_services(datadict):
+    """ Services whose strace or java verbose step did not succeed """
+
+    failed = []
+    for k, v in datadict.items():
+        if k == "tracer_metadata":
+            continue
+        if 'rc.cmd_strace' not in v or 'rc.java_verbose' not in v:
+            failed.append(k)
+        elif v['rc.cmd_strace'] != 0 or v['rc.java_verbose'] != 0:
+            failed.append(k)
+    return failed
+
+
 def nothread_worker(svckey):
     """ Worker for both serial and parallel tracer """
 
@@ -4878,6 +7376,9 @@ def nothread_worker(svckey):
         cmd = svc['cmd']
     if 'class' in svc:
         cmdclass = svc['class']
+    if cmdclass == 'SparkTrace' and capture_backend(options, svckey) == 'dry':
+        # ask the spark launcher instead of running a spark job
+        cmdclass = 'SparkLauncherTrace'
 
     rdict = {'JRE': None,
              'CLASSPATH': None,
@@ -4937,7 +7438,8 @@ def nothread_worker(svckey):
 
             rdict['rc.cmd_strace'] = XC.rc_strace
             rdict['rc.java_verbose'] = XC.rc_verbose
-            rdict['version'] = XC.version
+            rdict['version'] = XC.version or \
+                service_version(svckey, XC.jars)
             rdict['jre'] = XC.jre
             rdict['straced_classpath'] = XC.STRACED_CLASSPATH
             rdict['classpath'] = XC.classpath
@@ -4958,6 +7460,9 @@ def nothread_worker(svckey):
                     10))
             LOG.info("%s - Exception: %s %s", svckey, e, tbtext)
 
+    # Save the results in case this run does not make it to the end
+    write_checkpoint(options.checkpointdir, svckey, rdict)
+
     # Cleanup the lock
     os.remove(lockfile)
 
@@ -4996,10 +7501,17 @@ def threaded_tracer(options):
                 done_queue,
                 options)).start()
 
+    # the copy threads must not exist while the workers are forked
+    if COPYPIPELINE:
+        COPYPIPELINE.start()
+
     # Collect results
     results = []
     for i in range(NUMBER_OF_PROCESSES):
-        results.append(done_queue.get())
+        result = done_queue.get()
+        if COPYPIPELINE:
+            COPYPIPELINE.add(result[0], result[1])
+        results.append(result)
 
     for i in range(NUMBER_OF_PROCESSES):
         task_queue.put('STOP')
@@ -5028,6 +7540,8 @@ def nothread_tracer(options, rerun=False, timeout=TIMEOUT):
 
         rdict = nothread_worker(svc)
         datadict[svc] = rdict
+        if COPYPIPELINE:
+            COPYPIPELINE.add(svc, rdict)
 
     return datadict
 
@@ -5288,6 +7802,8 @@ def main(options=None):
     global r_xmlprops
     global TIMEOUT
     global WORKDIR
+    global PROBECACHE
+    global COPYPIPELINE
     global LOG
     g_jarlist = None
     if not os.path.exists(options.json):
@@ -5301,6 +7817,13 @@ def main(options=None):
     if 'RemoveXMLProps' in SERVICES:
         r_xmlprops = SERVICES['RemoveXMLProps']
         SERVICES.pop('RemoveXMLProps')
+    # The probe cache is meant to outlive the tmpdir
+    if options.probecache:
+        PROBECACHE = os.path.abspath(options.probecache)
+
+    # Snapshot the process table once, before the tracers are forked
+    processtable()
+
     # Override the base directory if specified
     WORKDIR_BAK = WORKDIR
     if options.tmpdir:
@@ -5313,6 +7836,10 @@ def main(options=None):
             options.tmpdir, os.path.basename(options.dir))
         options.filename = os.path.join(
             options.tmpdir, os.path.basename(options.filename))
+        for x in ['appcds', 'bundle', 'classpathfile', 'classpathjar']:
+            if getattr(options, x):
+                setattr(options, x, os.path.join(
+                    options.tmpdir, os.path.basename(getattr(options, x))))
 
         if not os.path.isdir(options.tmpdir):
             os.makedirs(options.tmpdir)
@@ -5321,6 +7848,13 @@ def main(options=None):
     else:
         WORKDIR = tempfile.mkdtemp(prefix="hadooptracer.")
 
+    # Finished services are saved next to the results by default
+    if not options.checkpointdir:
+        options.checkpointdir = os.path.join(
+            os.path.dirname(os.path.abspath(options.filename)),
+            "hadooptracer.checkpoints")
+    options.checkpointdir = os.path.abspath(options.checkpointdir)
+
     # Fixup the tmp file locations in some of the older tracers
     for k, v in SERVICES.items():
         if 'pre' in v:
@@ -5372,10 +7906,6 @@ def main(options=None):
             SERVICES.pop('yarn-node', None)
             SERVICES.pop('yarn-apps', None)
 
-    # Add MR1 exclusions if this is 2.x ...
-    if not options.noexclusions:
-        options.excludepackage = add_hadoop_mr1_filter(options.excludepackage)
-
     if options.listsvckeys:
         pprint(SERVICES)
         return 0
@@ -5409,92 +7939,155 @@ def main(options=None):
             toggle_hivejdbc_or_beeline()
 
     converge_services()
-    # Wait till all other tracers are finished before running mapreduce
-    # it seems as though a single MR job can cause all other tracers
-    # to hang up on the backend calls (especially on a mapr sandbox)
-    MRSERVICES = None
-    if not options.nothreads and 'mapreduce' in SERVICES and len(
-            list(SERVICES.keys())) > 1:
-        MRSERVICES = copy.deepcopy(SERVICES)
-        SERVICES.pop('mapreduce', None)
-
-    # trace defined commands threaded or not threaded
-    if not options.nothreads:
-        LOG.debug("Running the script in parallel tracing mode.")
-        datadict = threaded_tracer(options)
-        LOG.debug("Finished with the parallel tracing mode.")
+
+    # Reuse the services a previous run finished, and trace the rest
+    resumed = {}
+    if options.retracefailed:
+        # only the failed services of the results file are traced again
+        resumed = load_results(options.retracefailed)
+        failed = failed_services(resumed)
+        for k in list(SERVICES.keys()):
+            if k not in failed:
+                SERVICES.pop(k, None)
+        resumed = dict([(k, v) for k, v in resumed.items()
+                        if k not in SERVICES])
+        LOG.info("retracing the failed services of %s: %s",
+                 options.retracefailed, sorted(SERVICES.keys()))
+        clear_checkpoints(options.checkpointdir)
+    elif options.resume:
+        resumed = load_checkpoints(options.checkpointdir)
+        failed = failed_services(resumed)
+        resumed = dict([(k, v) for k, v in resumed.items()
+                        if k in SERVICES and k not in failed])
+        for k in resumed.keys():
+            SERVICES.pop(k, None)
+        LOG.info("resuming from %s - reusing %s, tracing %s",
+                 options.checkpointdir, sorted(resumed.keys()),
+                 sorted(SERVICES.keys()))
     else:
-        LOG.debug("Running the script in serial tracing mode.")
-        datadict = nothread_tracer(options)
-
-    # Run mapreduce now
-    if not options.nothreads and MRSERVICES:
-        LOG.info("Running the script just for the Hadoop MapReduce service in a serial mode...")
-        SERVICES = {}
-        SERVICES['mapreduce'] = MRSERVICES['mapreduce']
-        mrdict = nothread_tracer(options)
-        # copy the results back to the main dict
-        datadict['mapreduce'] = copy.deepcopy(mrdict['mapreduce'])
-        # fix the services dict
-        SERVICES = copy.deepcopy(MRSERVICES)
-
-        # Only use hadoop classpath if tracing hadoop
-        if not options.nohadoopclasspath:
-            if (not options.svckey and not options.command) \
-                    or ("hadoop" in SERVICES) or ("hadoop-put" in SERVICES):
-
-                LOG.debug("Checking the 'Hadoop Classpath' command output")
-                hcpjars = hadoopclasspathcmd()
-                datadict['hadoop-classpath'] = {}
-                datadict['hadoop-classpath']['rc.cmd_strace'] = 0
-                datadict['hadoop-classpath']['rc.java_verbose'] = 0
-                datadict['hadoop-classpath']['jarfiles'] = hcpjars
-
-    # Some poorly provisioned clusters (such as sandboxes)
-    # have issues with concurrency, so various tracers will
-    # fail for no good reason. Due to that "problem", attempt
-    # to rerun those tracers in serialized mode.
-    if not options.skipretry:
-        LOG.debug("Investigating the failures for the script to decide if re-run should be done.")
-        keys = datadict.keys()
-        failed_keys = []
-        for k, v in datadict.items():
-            if 'rc.cmd_strace' not in v or 'rc.java_verbose' not in v:
-                failed_keys.append(k)
-            elif v['rc.cmd_strace'] != 0 or v['rc.java_verbose'] != 0:
-                failed_keys.append(k)
-        LOG.debug("retracing: %s", failed_keys)
-
-        # save the traced data to avoid re-running strace
-        DATACACHE = copy.deepcopy(datadict)
-
-        # save the global services dict
-        for key in keys:
-            if key not in failed_keys:
-                SERVICES.pop(key, None)
-
-        retry_dict = nothread_tracer(options, rerun=True)
-
-        # merge the new data back into the datadict
-        for key in failed_keys:
-            if key in retry_dict:
-                datadict[key] = copy.deepcopy(retry_dict[key])
-            else:
-                datadict[key] = {}
-                datadict[key]['rc.cmd_strace'] = -1
-                datadict[key]['rc.java_verbose'] = -1
+        clear_checkpoints(options.checkpointdir)
 
-    # LOG.info("Copy jars to %s" % options.dir)
-    copyjars(options, datadict)
-    LOG.debug("filtering the JAR files")
-    dedupejars(options)
+    # Find commands, classpaths, the jdk and hive settings up front, for
+    # the services that are left to trace
+    prefetch(options)
 
-    LOG.info("copy site xml files to %s", options.conf)
-    copyconfig(options, datadict)
-    LOG.info("verifying that the required site xml files exist")
-    found_allsitexmls(options)
+    # Add MR1 exclusions if this is 2.x ...
+    if not options.noexclusions:
+        options.excludepackage = add_hadoop_mr1_filter(options.excludepackage)
+
+    # Start copying the files of each service as soon as it finishes
+    COPYPIPELINE = CopyPipeline(options.dir)
+    try:
+        for k, v in resumed.items():
+            COPYPIPELINE.add(k, v)
+        if options.nothreads:
+            # no tracer processes are forked
+            COPYPIPELINE.start()
+
+        # Wait till all other tracers are finished before running mapreduce
+        # it seems as though a single MR job can cause all other tracers
+        # to hang up on the backend calls (especially on a mapr sandbox)
+        MRSERVICES = None
+        if not options.nothreads and 'mapreduce' in SERVICES and len(
+                list(SERVICES.keys())) > 1:
+            MRSERVICES = copy.deepcopy(SERVICES)
+            SERVICES.pop('mapreduce', None)
+
+        # trace defined commands threaded or not threaded
+        if not options.nothreads:
+            LOG.debug("Running the script in parallel tracing mode.")
+            datadict = threaded_tracer(options)
+            LOG.debug("Finished with the parallel tracing mode.")
+        else:
+            LOG.debug("Running the script in serial tracing mode.")
+            datadict = nothread_tracer(options)
+
+        # Run mapreduce now
+        if not options.nothreads and MRSERVICES:
+            LOG.info("Running the script just for the Hadoop MapReduce service in a serial mode...")
+            SERVICES = {}
+            SERVICES['mapreduce'] = MRSERVICES['mapreduce']
+            mrdict = nothread_tracer(options)
+            # copy the results back to the main dict
+            datadict['mapreduce'] = copy.deepcopy(mrdict['mapreduce'])
+            # fix the services dict
+            SERVICES = copy.deepcopy(MRSERVICES)
+
+            # Only use hadoop classpath if tracing hadoop
+            if not options.nohadoopclasspath:
+                if (not options.svckey and not options.command) \
+                        or ("hadoop" in SERVICES) or ("hadoop-put" in SERVICES) \
+                        or ("hadoop" in resumed) or ("hadoop-put" in resumed):
+
+                    LOG.debug("Checking the 'Hadoop Classpath' command output")
+                    hcpjars = hadoopclasspathcmd()
+                    datadict['hadoop-classpath'] = {}
+                    datadict['hadoop-classpath']['rc.cmd_strace'] = 0
+                    datadict['hadoop-classpath']['rc.java_verbose'] = 0
+                    datadict['hadoop-classpath']['jarfiles'] = hcpjars
+
+        # the resumed services finished in the previous run
+        for k, v in resumed.items():
+            if k not in datadict:
+                datadict[k] = v
+
+        # Some poorly provisioned clusters (such as sandboxes)
+        # have issues with concurrency, so various tracers will
+        # fail for no good reason. Due to that "problem", attempt
+        # to rerun those tracers in serialized mode.
+        if not options.skipretry:
+            LOG.debug("Investigating the failures for the script to decide if re-run should be done.")
+            keys = list(datadict.keys())
+            failed_keys = failed_services(datadict)
+            LOG.debug("retracing: %s", failed_keys)
+
+            # save the traced data to avoid re-running strace
+            DATACACHE = copy.deepcopy(datadict)
+
+            # save the global services dict
+            for key in keys:
+                if key not in failed_keys:
+                    SERVICES.pop(key, None)
+
+            retry_dict = nothread_tracer(options, rerun=True)
+
+            # merge the new data back into the datadict
+            for key in failed_keys:
+                if key in retry_dict:
+                    datadict[key] = copy.deepcopy(retry_dict[key])
+                else:
+                    datadict[key] = {}
+                    datadict[key]['rc.cmd_strace'] = -1
+                    datadict[key]['rc.java_verbose'] = -1
+
+        # LOG.info("Copy jars to %s" % options.dir)
+        jardir = copyjars(options, datadict)
+        LOG.debug("filtering the JAR files")
+        dedupejars(options, jardir.path)
+        jardir.commit()
+
+        if options.appcds:
+            LOG.info("writing AppCDS class lists to %s", options.appcds)
+            write_appcds(options, datadict)
+
+        if options.classpathfile or options.classpathjar:
+            LOG.info("writing the hot-first classpath")
+            write_ordered_classpath(options, datadict)
+            Manifest(options.dir).refresh()
+
+        LOG.info("copy site xml files to %s", options.conf)
+        copyconfig(options, datadict).commit()
+        LOG.info("verifying that the required site xml files exist")
+        found_allsitexmls(options)
+    finally:
+        COPYPIPELINE.close()
+        COPYPIPELINE = None
 
     write_hadooptracer_json(options, localinfo, datadict)
+
+    # Keep the checkpoints only if --resume has something left to retry
+    if not failed_services(datadict) and not options.noclean:
+        clear_checkpoints(options.checkpointdir)
     # LOG.info("Combine site.xml files into combined-site.xml")
     # sitexmlcombiner(options.conf)
 
@@ -5532,6 +8125,7 @@ def main(options=None):
     if options.pp:
         LOG.debug("run the post processing step to update the site xml files")
         post_processsitexmls(options)
+        Manifest(options.conf).refresh(rehash=True)
     else:
         LOG.debug("skip the post processing step to modify the site xml files")
 
@@ -5540,6 +8134,15 @@ def main(options=None):
             if 'spark.driver.extraClassPath' in spkfile.read():
                 LOG.info("***************************** The Hive service is llap enabled. Make sure that you follow the instructions that are stated in the Deployment Guide to set up the Hive transactional tables support. **************************************** ")
 
+    if options.bundle:
+        write_bundle(options)
+
+    if options.publish:
+        LOG.info("publishing the jars and site xmls to %s", options.publish)
+        if publish(options):
+            LOG.error("publishing to %s failed", options.publish)
+            return 1
+
     if options.stoponerror:
         LOG.info("failed with the return code: %s [%s]", rc, str(failed))
         return rc
@@ -5572,6 +8175,61 @@ if __name__ == "__main__":
                         help="Copy and paste the Hadoop config files to this directory",
                         default="/tmp/sitexmls",
                         action="store", dest="conf")
+    parser.add_argument("--appcds",
+                        help="Write AppCDS class lists (and archives if java is found) to this directory",
+                        default=None,
+                        action="store", dest="appcds")
+    parser.add_argument("--classpathfile",
+                        help="Write the collected jars as a classpath ordered by class load frequency",
+                        default=None,
+                        action="store", dest="classpathfile")
+    parser.add_argument("--classpathjar",
+                        help="Write a manifest-only jar with the ordered classpath as its Class-Path",
+                        default=None,
+                        action="store", dest="classpathjar")
+    parser.add_argument("--backend",
+                        help="Capture the java commands with this backend for all services [%s]. "
+                             "dry asks the spark launcher for the spark command instead of running a job. "
+                             "proc only sees the config files the jvm holds open or names in -D options, "
+                             "other site xmls it reads are missed" % '|'.join(CAPTUREBACKENDS),
+                        default=None,
+                        action="store", dest="backend")
+    parser.add_argument("--localprobes",
+                        help="Run the mapreduce and spark probes with the local runner instead of yarn and hdfs",
+                        default=False,
+                        action="store_true", dest="localprobes")
+    parser.add_argument("--probecache",
+                        help="Keep the compiled java probe programs in this directory [%s]" % PROBECACHE,
+                        default=None,
+                        action="store", dest="probecache")
+    parser.add_argument("--checkpointdir",
+                        help="Save the results of each finished service in this directory [next to the results file]",
+                        default=None,
+                        action="store", dest="checkpointdir")
+    parser.add_argument("--resume",
+                        help="Reuse the services a previous run saved in the checkpoint directory and trace only the rest",
+                        default=False,
+                        action="store_true", dest="resume")
+    parser.add_argument("--retrace-failed",
+                        help="Trace again only the services that failed in this results file and merge the new results with it",
+                        default=None,
+                        action="store", dest="retracefailed", metavar="FILE")
+    parser.add_argument("--bundle",
+                        help="Also write the jar and conf directories to this reproducible tar (.tar, .tar.gz or .tgz)",
+                        default=None,
+                        action="store", dest="bundle", metavar="FILE")
+    parser.add_argument("--publish",
+                        help="Upload the jars and site xmls to s3://bucket/prefix, azure://account/container/prefix or gs://bucket/prefix",
+                        default=None,
+                        action="store", dest="publish", metavar="URL")
+    parser.add_argument("--publishendpoint",
+                        help="Use this endpoint for --publish, such as an Azurite, fake-gcs-server or S3 compatible server",
+                        default=None,
+                        action="store", dest="publishendpoint", metavar="URL")
+    parser.add_argument("--verify",
+                        help="Check a jar or conf directory against its manifest and exit (can be repeated)",
+                        default=None,
+                        action="append", dest="verify", metavar="DIR")
     parser.add_argument("--logfile",
                         help="Create a log file with this name in this location",
                         default="/tmp/hadooptracer.log",
@@ -5716,4 +8374,8 @@ if __name__ == "__main__":
     if '--version' in sys.argv:
         print("Current version of the hadooptracer script: 20w34.01")
         sys.exit(0)
+    if options.verify:
+        # every directory is checked, the exit code only says if any failed
+        problems = [verify_manifest(x) for x in options.verify]
+        sys.exit(1 if any(problems) else 0)
     sys.exit(main(options=options))